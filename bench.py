@@ -0,0 +1,283 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import logging as log
+import os
+import os.path
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+
+import commentDB
+import helper
+import spelling
+
+"""
+benchmarks of the hot paths on a seeded synthetic comment corpus.
+needs the card json files and a credentials.py, like the bot.
+
+    python3 bench.py -o before.json
+    python3 bench.py -o after.json
+    python3 bench.py compare before.json after.json
+"""
+
+# seen/topcomment rows in the db benchmarks
+db_sizes = (1000, 10000, 100000)
+words = ('the', 'shot', 'fly', 'ship', 'list', 'tournament', 'dice', 'red', 'focus',
+         'evade', 'turn', 'roll', 'barrel', 'k-turn', 'points', 'squad', 'wave')
+
+
+def makeCorpus(names, count, seed):
+    """ comments like on reddit: mostly no cards, some typos, quotes and code """
+    rnd = random.Random(seed)
+
+    def sentence():
+        return ' '.join(rnd.choice(words) for _ in range(rnd.randint(5, 30)))
+
+    def cardName():
+        name = rnd.choice(names)
+        kind = rnd.random()
+        if kind < 0.1 and len(name) > 4:
+            # typo
+            i = rnd.randrange(len(name))
+            name = name[:i] + name[i+1:]
+        elif kind < 0.2 and len(name) > 5:
+            # prefix
+            name = name[:rnd.randint(3, len(name) - 1)]
+        return name
+
+    corpus = []
+    for _ in range(count):
+        parts = [sentence() for _ in range(rnd.randint(1, 6))]
+        kind = rnd.random()
+        if kind < 0.3:
+            parts.insert(rnd.randrange(len(parts) + 1),
+                         ' '.join('[[{}]]'.format(cardName()) for _ in range(rnd.randint(1, 4))))
+        if 0.2 < kind < 0.35:
+            parts.insert(0, '> ' + sentence() + ' [[{}]]'.format(cardName()))
+        if 0.3 < kind < 0.4:
+            parts.append('```\n[[{}]]\n```'.format(cardName()))
+        corpus.append('\n\n'.join(parts))
+    return corpus
+
+
+def measure(stmt, setup=None, repeat=5, number=None):
+    """ seconds per call: best and median of repeat runs """
+    timer = timeit.Timer(stmt, setup or (lambda: None))
+    if number is None:
+        number, _ = timer.autorange()
+    runs = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {'best_us': min(runs) * 1e6, 'median_us': statistics.median(runs) * 1e6,
+            'number': number}
+
+
+def benchParsing(results, card_db, spell_check, corpus):
+    def parseAll():
+        for text in corpus:
+            helper.getCardsFromComment(text, spell_check, ignore_quotes=True)
+    result = measure(parseAll, number=1)
+    results['getCardsFromComment'] = perItem(result, len(corpus))
+
+    card_lists = list({tuple(cards): cards for cards in
+                       helper.getCardsFromComments(corpus, spell_check) if cards}.values())
+    # no more than fit in the cache, or the cached run would evict itself
+    card_lists = card_lists[:helper.reply_cache_size]
+    def renderAll():
+        for cards in card_lists:
+            helper.getTextForCards(card_db, cards)
+    results['getTextForCards_cold'] = perItem(
+            measure(renderAll, setup=card_db.replies.clear, number=1), len(card_lists))
+    renderAll()
+    results['getTextForCards_cached'] = perItem(measure(renderAll, number=1), len(card_lists))
+
+
+def perItem(result, count):
+    return {'best_us': result['best_us'] / count, 'median_us': result['median_us'] / count,
+            'number': result['number'] * count}
+
+
+def benchCards(results):
+    with open(helper.CARDS_JSON, 'r') as infofile:
+        cards = json.load(infofile)
+    texts = []
+    for path in (helper.PILOT_TEXT_JSON, helper.UPGRADE_TEXT_JSON,
+                 helper.MODIFICATION_TEXT_JSON, helper.TITLE_TEXT_JSON):
+        with open(path, 'r') as infofile:
+            texts.append(json.load(infofile))
+
+    results['createCardDB'] = measure(lambda: helper._createCardDB(cards, *texts), repeat=3)
+    results['loadCardDB'] = measure(helper.loadCardDB, repeat=3)
+
+
+def benchSpelling(results, names, seed):
+    rnd = random.Random(seed)
+    checker = spelling.Checker(names)
+    broken = []
+    for _ in range(500):
+        name = rnd.choice(names)
+        i = rnd.randrange(len(name))
+        broken.append(name[:i] + rnd.choice('abcdefghijklmnopqrstuvwxyz') + name[i+1:])
+
+    def clearMemo():
+        checker._memo.clear()
+        checker._unfixable.clear()
+    def correctAll():
+        for word in broken:
+            checker.correct(word)
+    results['Checker.correct'] = perItem(measure(correctAll, setup=clearMemo, number=1), len(broken))
+    results['Checker.correct_memo'] = perItem(measure(correctAll, number=1), len(broken))
+
+
+def benchDB(results, size, tmp_dir):
+    db_name = os.path.join(tmp_dir, 'bench-{}.db'.format(size))
+    db = commentDB.DB(db_name)
+    now = int(time.time())
+    with db.transaction():
+        db.conn.executemany('INSERT INTO seen_comment (comment_id, created) VALUES (?, ?)',
+                            (('c{}'.format(i), now - i % 3600) for i in range(size)))
+        db.conn.executemany('INSERT INTO topcomment (submission_id, card, created) VALUES (?, ?, ?)',
+                            (('s{}'.format(i // 3), 'card{}'.format(i % 3), now)
+                             for i in range(size)))
+    db.close()
+    # the seen cache is filled on start, like in the bot
+    db = commentDB.DB(db_name)
+    suffix = '_{}'.format(size)
+    rnd = random.Random(size)
+    ids = ['c{}'.format(rnd.randrange(size * 2)) for _ in range(1000)]
+    parents = ['s{}'.format(rnd.randrange(size // 3)) for _ in range(1000)]
+
+    def seenAll():
+        for comment_id in ids:
+            db.isSeenComment(comment_id)
+    results['isSeenComment_cache' + suffix] = perItem(measure(seenAll, number=1), len(ids))
+
+    # what a miss costs once the cache had to drop ids
+    empty = commentDB.SeenCache()
+    empty.complete = False
+    query = 'SELECT EXISTS (SELECT 1 FROM seen_comment WHERE comment_id = ?)'
+    def seenAllSqlite():
+        for comment_id in ids:
+            db._isSeen(empty, query, comment_id)
+    results['isSeenComment_sqlite' + suffix] = perItem(measure(seenAllSqlite, number=1), len(ids))
+
+    def existsAll():
+        for parent in parents:
+            db.exists(parent, ['card0', 'card1'])
+    results['exists' + suffix] = perItem(measure(existsAll, number=1), len(parents))
+
+    batch = iter(range(10 ** 9))
+    def insertCycle():
+        # one poll: 100 seen marks and 10 answers, one commit
+        with db.transaction():
+            db.addSeenComments(['n{}'.format(next(batch)) for _ in range(100)])
+            for _ in range(10):
+                db.insertCards('p{}'.format(next(batch)), ['card0', 'card1'])
+    results['insertCycle' + suffix] = measure(insertCycle, number=5)
+
+    def expire():
+        with db.transaction():
+            db.conn.executemany('INSERT OR IGNORE INTO seen_comment (comment_id, created)'
+                                ' VALUES (?, ?)', (('old{}'.format(i), 0) for i in range(100)))
+    results['cleanupSeenComment_batch' + suffix] = measure(
+            lambda: db.cleanupSeenComment(limit=100), setup=expire, number=1, repeat=10)
+    db.close()
+
+
+def run(args):
+    # the card db is part of the benchmark, the snapshot would hide it
+    card_db = helper.loadCardDB()
+    spell_check = helper.spellChecker(card_db)
+    names = card_db.names()
+    corpus = makeCorpus(names, args.comments, args.seed)
+
+    results = {}
+    print('parsing', len(corpus), 'comments', file=sys.stderr)
+    benchParsing(results, card_db, spell_check, corpus)
+    print('card db', file=sys.stderr)
+    benchCards(results)
+    print('spelling', file=sys.stderr)
+    benchSpelling(results, names, args.seed)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for size in args.db_sizes:
+            print('db with', size, 'rows', file=sys.stderr)
+            benchDB(results, size, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report = {
+        'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seed': args.seed,
+                 'comments': args.comments, 'python': platform.python_version(),
+                 'machine': platform.machine(), 'platform': platform.platform()},
+        'results': results
+    }
+    with open(args.output, 'w', newline='\n') as f:
+        json.dump(report, f, sort_keys=True, indent=2)
+
+    for name, result in sorted(results.items()):
+        print('{:40} {:12.2f} us'.format(name, result['best_us']))
+    print('saved', args.output)
+
+
+def compare(args):
+    """ prints old and new per benchmark, exit code 1 on regressions """
+    with open(args.old, 'r') as f:
+        old = json.load(f)['results']
+    with open(args.new, 'r') as f:
+        new = json.load(f)['results']
+
+    regressions = 0
+    for name in sorted(set(old) | set(new)):
+        if name not in old or name not in new:
+            print('{:40} only in {}'.format(name, 'new' if name in new else 'old'))
+            continue
+        ratio = new[name]['best_us'] / old[name]['best_us']
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            flag = 'faster'
+        print('{:40} {:12.2f} {:12.2f} us {:7.2f}x {}'.format(
+                name, old[name]['best_us'], new[name]['best_us'], ratio, flag))
+    return 1 if regressions else 0
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='benchmarks of the bot hot paths')
+    commands = arg_parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='run the benchmarks (default)')
+    compare_parser = commands.add_parser('compare', help='compare two runs')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='slower than this fraction is a regression (0.1)')
+
+    # before or after run, the defaults come only from the top level parser,
+    # a subparser default would override an option given before run
+    arg_parser.set_defaults(output='bench.json', seed=1, comments=2000, db_sizes=db_sizes)
+    for parser in (arg_parser, run_parser):
+        parser.add_argument('-o', '--output', default=argparse.SUPPRESS)
+        parser.add_argument('--seed', type=int, default=argparse.SUPPRESS)
+        parser.add_argument('--comments', type=int, default=argparse.SUPPRESS)
+        parser.add_argument('--db-sizes', type=int, nargs='+', default=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    # the info logging of the parser would be most of what is measured
+    log.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=log.WARNING)
+    if args.command == 'compare':
+        return compare(args)
+    run(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,84 +1,487 @@
 
+import collections
+import contextlib
+import logging as log
 import sqlite3
 import itertools
 import time
 
+import metrics
+
+
+# PRAGMA user_version of the newest schema, see DB._migrate
+schema_version = 7
+
+
+class SeenCache():
+    """ in memory copy of the newest ids of a seen table """
+
+    def __init__(self, max_size = 100000):
+        self.max_size = max_size
+        # id -> created, oldest first
+        self._ids = collections.OrderedDict()
+        # False once ids were dropped for size, misses have to ask sqlite then
+        self.complete = True
+
+    def __contains__(self, seen_id):
+        return seen_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, seen_id, created):
+        self._ids[seen_id] = created
+        self._ids.move_to_end(seen_id)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+            self.complete = False
+
+    def expire(self, timestamp):
+        """ drops ids created at or before timestamp """
+        while self._ids:
+            seen_id, created = next(iter(self._ids.items()))
+            if created > timestamp:
+                break
+            del self._ids[seen_id]
+
+
+class Retention():
+    """
+    removes expired rows on its own schedule. every run deletes at most
+    max_batches batches of batch_size rows per table, what is left over
+    goes to the next run
+    """
+
+    def __init__(self, db, interval = 10 * 60, seen_ttl = 24 * 60 * 60,
+                 topcomment_ttl = 180 * 24 * 60 * 60,
+                 batch_size = 1000, max_batches = 10, vacuum_pages = 256):
+        self.db = db
+        self.interval = interval
+        self.seen_ttl = seen_ttl
+        self.topcomment_ttl = topcomment_ttl
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.vacuum_pages = vacuum_pages
+        self.next_run = 0
+
+    def _clean(self, cleanup, ttl):
+        deleted = 0
+        for _ in range(self.max_batches):
+            count = cleanup(ttl, self.batch_size)
+            deleted += count
+            if count < self.batch_size:
+                break
+        return deleted
+
+    def run(self, now = None):
+        """ cleans up if due, returns deleted rows per table or None """
+        now = now or time.time()
+        if now < self.next_run:
+            return None
+        self.next_run = now + self.interval
+
+        deleted = {
+            'seen_comment': self._clean(self.db.cleanupSeenComment, self.seen_ttl),
+            'seen_submission': self._clean(self.db.cleanupSeenSubmission, self.seen_ttl),
+            'seen_message': self._clean(self.db.cleanupSeenMessage, self.seen_ttl),
+            'topcomment': self._clean(self.db.cleanupTopComment, self.topcomment_ttl)
+        }
+        free_pages = self.db.incrementalVacuum(self.vacuum_pages)
+        log.debug('retention deleted %s, %s free pages left', deleted, free_pages)
+        return deleted
+
 
 class DB():
 
     def __init__(self, dbName = 'xwingminibot.db'):
         self.conn = sqlite3.connect(dbName)
+        # writes inside transaction() are committed once at its end
+        self._transaction_depth = 0
 
-        self.conn.execute("CREATE TABLE IF NOT EXISTS topcomment"
-                            " (submission_id text, card text,"
-                            " created integer(4) not null default (strftime('%s','now')))")
-        self.conn.execute('CREATE INDEX IF NOT EXISTS sub_card_idx ON topcomment (submission_id, card)')
+        # WAL needs a single fsync per commit and readers never wait.
+        # synchronous stays FULL: a seen mark lost on power loss means a double answer
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = FULL')
+        self.conn.execute('PRAGMA cache_size = -4096')
+        self.conn.execute('PRAGMA temp_store = MEMORY')
 
-        self.conn.execute("CREATE TABLE IF NOT EXISTS seen_comment"
-                            " (comment_id text,"
-                            " created integer(4) not null default (strftime('%s','now')))")
-        self.conn.execute('CREATE INDEX IF NOT EXISTS comment_idx ON seen_comment (comment_id)')
+        self._migrate()
 
-        self.conn.execute("CREATE TABLE IF NOT EXISTS seen_submission"
-                            " (submission_id text,"
-                            " created integer(4) not null default (strftime('%s','now')))")
-        self.conn.execute('CREATE INDEX IF NOT EXISTS submission_idx ON seen_submission (submission_id)')
-        self.conn.commit()
+        # most seen checks never touch sqlite
+        self._seen_comments = self._loadSeen('seen_comment', 'comment_id')
+        self._seen_submissions = self._loadSeen('seen_submission', 'submission_id')
+        self._seen_messages = self._loadSeen('seen_message', 'message_id')
 
 
     def __str__(self):
         return repr(self.conn)
 
 
+    def _migrate(self):
+        """ brings the tables up to schema_version """
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= schema_version:
+            return
+        # all steps or none, a crash must not leave half copied tables behind
+        self.conn.execute('BEGIN')
+        try:
+            if version < 1:
+                self._migrateKeyedTables()
+            if version < 2:
+                self._migrateCreatedIndex()
+            if version < 3:
+                self._migrateOutbox()
+            if version < 4:
+                self._migrateCursor()
+            if version < 5:
+                self._migrateSeenMessage()
+            if version < 6:
+                self._migrateThrottle()
+            if version < 7:
+                self._migrateOutboxSending()
+        except:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+        if version < 2:
+            # auto_vacuum only changes with a full VACUUM, once.
+            # afterwards freed pages can be returned with incrementalVacuum
+            self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.conn.execute('VACUUM')
+
+    def _migrateKeyedTables(self):
+        # version 1: the ids are primary keys, duplicates can't exist anymore.
+        # the unversioned tables had no keys, copy them over without duplicates
+        self.conn.execute("CREATE TABLE topcomment_v1"
+                            " (submission_id text not null, card text not null,"
+                            " created integer(4) not null default (strftime('%s','now')),"
+                            " PRIMARY KEY (submission_id, card)) WITHOUT ROWID")
+        self.conn.execute("CREATE TABLE seen_comment_v1"
+                            " (comment_id text not null primary key,"
+                            " created integer(4) not null default (strftime('%s','now')))"
+                            " WITHOUT ROWID")
+        self.conn.execute("CREATE TABLE seen_submission_v1"
+                            " (submission_id text not null primary key,"
+                            " created integer(4) not null default (strftime('%s','now')))"
+                            " WITHOUT ROWID")
+
+        tables = {row[0] for row in self.conn.execute(
+                        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if 'topcomment' in tables:
+            self.conn.execute("INSERT OR IGNORE INTO topcomment_v1"
+                                " SELECT submission_id, card, MIN(created) FROM topcomment"
+                                " WHERE submission_id NOT NULL AND card NOT NULL"
+                                " GROUP BY submission_id, card")
+            self.conn.execute("DROP TABLE topcomment")
+        if 'seen_comment' in tables:
+            self.conn.execute("INSERT OR IGNORE INTO seen_comment_v1"
+                                " SELECT comment_id, MAX(created) FROM seen_comment"
+                                " WHERE comment_id NOT NULL GROUP BY comment_id")
+            self.conn.execute("DROP TABLE seen_comment")
+        if 'seen_submission' in tables:
+            self.conn.execute("INSERT OR IGNORE INTO seen_submission_v1"
+                                " SELECT submission_id, MAX(created) FROM seen_submission"
+                                " WHERE submission_id NOT NULL GROUP BY submission_id")
+            self.conn.execute("DROP TABLE seen_submission")
+
+        self.conn.execute("ALTER TABLE topcomment_v1 RENAME TO topcomment")
+        self.conn.execute("ALTER TABLE seen_comment_v1 RENAME TO seen_comment")
+        self.conn.execute("ALTER TABLE seen_submission_v1 RENAME TO seen_submission")
+        self.conn.execute('PRAGMA user_version = 1')
+
+    def _migrateCreatedIndex(self):
+        # version 2: retention deletes the oldest rows first
+        self.conn.execute('CREATE INDEX seen_comment_created_idx ON seen_comment (created)')
+        self.conn.execute('CREATE INDEX seen_submission_created_idx ON seen_submission (created)')
+        self.conn.execute('CREATE INDEX topcomment_created_idx ON topcomment (created)')
+        self.conn.execute('PRAGMA user_version = 2')
+
+    def _migrateOutbox(self):
+        # version 3: replies (thing_id) and pms (user, subject) waiting to be sent
+        self.conn.execute("CREATE TABLE outbox"
+                            " (id integer primary key, thing_id text, user text, subject text,"
+                            " body text not null, attempts integer not null default 0,"
+                            " created integer(4) not null default (strftime('%s','now')))")
+        self.conn.execute('PRAGMA user_version = 3')
+
+    def _migrateCursor(self):
+        # version 4: newest fullname answered per listing
+        self.conn.execute("CREATE TABLE cursor"
+                            " (source text not null primary key, fullname text not null,"
+                            " created real not null) WITHOUT ROWID")
+        self.conn.execute('PRAGMA user_version = 4')
+
+    def _migrateSeenMessage(self):
+        # version 5: answered inbox messages, mark as read is not reliable
+        self.conn.execute("CREATE TABLE seen_message"
+                            " (message_id text not null primary key,"
+                            " created integer(4) not null default (strftime('%s','now')))"
+                            " WITHOUT ROWID")
+        self.conn.execute('CREATE INDEX seen_message_created_idx ON seen_message (created)')
+        self.conn.execute('PRAGMA user_version = 5')
+
+    def _migrateThrottle(self):
+        # version 6: events of throttles, kept over restarts
+        self.conn.execute("CREATE TABLE throttle"
+                            " (name text not null, key text not null, time real not null,"
+                            " PRIMARY KEY (name, key, time)) WITHOUT ROWID")
+        self.conn.execute('PRAGMA user_version = 6')
+
+    def _migrateOutboxSending(self):
+        # version 7: set while an item is sent, a crash leaves it set
+        self.conn.execute('ALTER TABLE outbox ADD COLUMN sending integer not null default 0')
+        self.conn.execute('PRAGMA user_version = 7')
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ groups all writes of the block (e.g. a poll cycle) into one commit """
+        self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            self._transaction_depth -= 1
+            # the writes record what already happened on reddit,
+            # keep them even if the block failed
+            if not self._transaction_depth:
+                self.conn.commit()
+
+    @metrics.timed('db_seconds', call='commit')
+    def commit(self):
+        """ commit now, even inside a transaction """
+        self.conn.commit()
+
+    def _autocommit(self):
+        if not self._transaction_depth:
+            self.conn.commit()
+
+
+    def _loadSeen(self, table, column):
+        cache = SeenCache()
+        query = ('SELECT {}, created FROM {} ORDER BY created DESC LIMIT ?'
+                    .format(column, table))
+        rows = self.conn.execute(query, (cache.max_size + 1, )).fetchall()
+        for seen_id, created in reversed(rows):
+            cache.add(seen_id, created)
+        return cache
+
+    def _isSeen(self, cache, query, seen_id):
+        if seen_id in cache:
+            return True
+        if cache.complete:
+            return False
+        cur = self.conn.execute(query, [seen_id])
+        found = cur.fetchone()[0]
+        cur.close()
+        return found == 1
+
+
+    def _deleteOlder(self, table, key, timestamp, limit = None):
+        """ deletes up to limit of the oldest rows created at or before timestamp """
+        if limit is None:
+            cur = self.conn.execute('DELETE FROM {} WHERE created <= ?'.format(table),
+                                    (timestamp, ))
+        else:
+            # the created index finds the oldest rows without a table scan
+            query = ('DELETE FROM {table} WHERE ({key}) IN'
+                        ' (SELECT {key} FROM {table} WHERE created <= ?'
+                        ' ORDER BY created LIMIT ?)').format(table=table, key=key)
+            cur = self.conn.execute(query, (timestamp, limit))
+        self._autocommit()
+        return cur.rowcount
+
+    @metrics.timed('db_seconds', call='incrementalVacuum')
+    def incrementalVacuum(self, pages = 256):
+        """ gives up to pages free pages back to the file system """
+        # the pragma frees one page per step. execute() steps a statement
+        # without result columns only once, fetchall() doesn't help.
+        # executescript() steps it to the end, after committing pending writes
+        self.conn.executescript('PRAGMA incremental_vacuum({:d})'.format(pages))
+        return self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+    @metrics.timed('db_seconds', call='exists')
     def exists(self, submission_id, cards):
         # true if all cards are already posted for parent
-        query = ('SELECT COUNT(1) FROM topcomment WHERE submission_id = ?'
+        cards = set(cards)
+        query = ('SELECT COUNT(DISTINCT card) FROM topcomment WHERE submission_id = ?'
                                 ' AND card IN (%s)' % ','.join('?' * len(cards)))
         params = list(itertools.chain((submission_id,), cards))
 
         cur = self.conn.execute(query, params)
         count = cur.fetchone()[0]
         cur.close()
-        return count >= len(cards)
+        return count == len(cards)
 
 
     def insert(self, submission_id, card):
-        self.conn.execute("INSERT INTO topcomment (submission_id, card) VALUES (?, ?)", (submission_id, card))
-        self.conn.commit()
+        self.insertCards(submission_id, [card])
+
+    @metrics.timed('db_seconds', call='insertCards')
+    def insertCards(self, submission_id, cards):
+        self.conn.executemany("INSERT OR IGNORE INTO topcomment (submission_id, card) VALUES (?, ?)",
+                              ((submission_id, card) for card in cards))
+        self._autocommit()
+
+    @metrics.timed('db_seconds', call='cleanupTopComment')
+    def cleanupTopComment(self, seconds_old = 180 * 24 * 60 * 60, limit = None):
+        timestamp = int(time.time()) - seconds_old
+        return self._deleteOlder('topcomment', 'submission_id, card', timestamp, limit)
 
 
     def addSeenComment(self, comment_id):
-        self.conn.execute("INSERT INTO seen_comment (comment_id) VALUES (?)", (comment_id, ))
-        self.conn.commit()
+        self.addSeenComments([comment_id])
 
+    @metrics.timed('db_seconds', call='addSeenComments')
+    def addSeenComments(self, comment_ids):
+        now = int(time.time())
+        comment_ids = list(comment_ids)
+        for comment_id in comment_ids:
+            self._seen_comments.add(comment_id, now)
+        self.conn.executemany("INSERT OR IGNORE INTO seen_comment (comment_id) VALUES (?)",
+                              ((comment_id, ) for comment_id in comment_ids))
+        self._autocommit()
+
+    @metrics.timed('db_seconds', call='isSeenComment')
     def isSeenComment(self, comment_id):
-        query = 'SELECT COUNT(1) FROM seen_comment WHERE comment_id = ?'
-        cur = self.conn.execute(query, [comment_id])
-        count = cur.fetchone()[0]
-        cur.close()
-        return count >= 1
+        query = 'SELECT EXISTS (SELECT 1 FROM seen_comment WHERE comment_id = ?)'
+        return self._isSeen(self._seen_comments, query, comment_id)
 
-    def cleanupSeenComment(self, seconds_old = 24 * 60 * 60):
+    @metrics.timed('db_seconds', call='cleanupSeenComment')
+    def cleanupSeenComment(self, seconds_old = 24 * 60 * 60, limit = None):
         timestamp = int(time.time()) - seconds_old
-        self.conn.execute("DELETE FROM seen_comment WHERE created <= ?", (timestamp, ))
-        self.conn.commit()
+        self._seen_comments.expire(timestamp)
+        return self._deleteOlder('seen_comment', 'comment_id', timestamp, limit)
 
 
     def addSeenSubmission(self, submission_id):
-        self.conn.execute("INSERT INTO seen_submission (submission_id) VALUES (?)", (submission_id, ))
-        self.conn.commit()
+        self.addSeenSubmissions([submission_id])
 
+    @metrics.timed('db_seconds', call='addSeenSubmissions')
+    def addSeenSubmissions(self, submission_ids):
+        now = int(time.time())
+        submission_ids = list(submission_ids)
+        for submission_id in submission_ids:
+            self._seen_submissions.add(submission_id, now)
+        self.conn.executemany("INSERT OR IGNORE INTO seen_submission (submission_id) VALUES (?)",
+                              ((submission_id, ) for submission_id in submission_ids))
+        self._autocommit()
+
+    @metrics.timed('db_seconds', call='isSeenSubmission')
     def isSeenSubmission(self, submission_id):
-        query = 'SELECT COUNT(1) FROM seen_submission WHERE submission_id = ?'
-        cur = self.conn.execute(query, [submission_id])
-        count = cur.fetchone()[0]
-        cur.close()
-        return count >= 1
+        query = 'SELECT EXISTS (SELECT 1 FROM seen_submission WHERE submission_id = ?)'
+        return self._isSeen(self._seen_submissions, query, submission_id)
 
-    def cleanupSeenSubmission(self, seconds_old = 24 * 60 * 60):
+    @metrics.timed('db_seconds', call='cleanupSeenSubmission')
+    def cleanupSeenSubmission(self, seconds_old = 24 * 60 * 60, limit = None):
         timestamp = int(time.time()) - seconds_old
-        self.conn.execute("DELETE FROM seen_submission WHERE created <= ?", (timestamp, ))
-        self.conn.commit()
+        self._seen_submissions.expire(timestamp)
+        return self._deleteOlder('seen_submission', 'submission_id', timestamp, limit)
+
+
+    @metrics.timed('db_seconds', call='addSeenMessages')
+    def addSeenMessages(self, message_ids):
+        now = int(time.time())
+        message_ids = list(message_ids)
+        for message_id in message_ids:
+            self._seen_messages.add(message_id, now)
+        self.conn.executemany("INSERT OR IGNORE INTO seen_message (message_id) VALUES (?)",
+                              ((message_id, ) for message_id in message_ids))
+        self._autocommit()
+
+    @metrics.timed('db_seconds', call='isSeenMessage')
+    def isSeenMessage(self, message_id):
+        query = 'SELECT EXISTS (SELECT 1 FROM seen_message WHERE message_id = ?)'
+        return self._isSeen(self._seen_messages, query, message_id)
+
+    @metrics.timed('db_seconds', call='cleanupSeenMessage')
+    def cleanupSeenMessage(self, seconds_old = 24 * 60 * 60, limit = None):
+        timestamp = int(time.time()) - seconds_old
+        self._seen_messages.expire(timestamp)
+        return self._deleteOlder('seen_message', 'message_id', timestamp, limit)
+
+
+    @metrics.timed('db_seconds', call='cursor')
+    def cursor(self, source):
+        """ (fullname, created) of the newest item of source or None """
+        row = self.conn.execute('SELECT fullname, created FROM cursor WHERE source = ?',
+                                (source, )).fetchone()
+        return row and tuple(row)
+
+    @metrics.timed('db_seconds', call='setCursor')
+    def setCursor(self, source, fullname, created):
+        self.conn.execute('INSERT OR REPLACE INTO cursor (source, fullname, created)'
+                          ' VALUES (?, ?, ?)', (source, fullname, created))
+        self._autocommit()
+
+
+    @metrics.timed('db_seconds', call='throttleEvents')
+    def throttleEvents(self, name):
+        """ saved (key, time) events of throttle name """
+        return self.conn.execute('SELECT key, time FROM throttle WHERE name = ?',
+                                 (name, )).fetchall()
+
+    @metrics.timed('db_seconds', call='saveThrottleEvents')
+    def saveThrottleEvents(self, name, events, expired):
+        """ adds new (key, time) events of throttle name, deletes those at or before expired """
+        self.conn.executemany('INSERT OR IGNORE INTO throttle (name, key, time) VALUES (?, ?, ?)',
+                              ((name, key, event) for key, event in events))
+        self.conn.execute('DELETE FROM throttle WHERE name = ? AND time <= ?', (name, expired))
+        self._autocommit()
+
+
+    @metrics.timed('db_seconds', call='queueReply')
+    def queueReply(self, thing_id, body):
+        self.conn.execute("INSERT INTO outbox (thing_id, body) VALUES (?, ?)",
+                          (thing_id, body))
+        self._autocommit()
+
+    @metrics.timed('db_seconds', call='queueMessage')
+    def queueMessage(self, user, subject, body):
+        self.conn.execute("INSERT INTO outbox (user, subject, body) VALUES (?, ?, ?)",
+                          (user, subject, body))
+        self._autocommit()
+
+    @metrics.timed('db_seconds', call='outbox')
+    def outbox(self, limit = -1):
+        """ oldest queued (id, thing_id, user, subject, body, attempts) first """
+        query = ('SELECT id, thing_id, user, subject, body, attempts'
+                    ' FROM outbox ORDER BY id LIMIT ?')
+        return self.conn.execute(query, (limit, )).fetchall()
+
+    @metrics.timed('db_seconds', call='outboxSize')
+    def outboxSize(self):
+        return self.conn.execute('SELECT COUNT(1) FROM outbox').fetchone()[0]
+
+    @metrics.timed('db_seconds', call='removeOutbox')
+    def removeOutbox(self, outbox_id):
+        self.conn.execute('DELETE FROM outbox WHERE id = ?', (outbox_id, ))
+        self._autocommit()
+
+    @metrics.timed('db_seconds', call='sendingOutbox')
+    def sendingOutbox(self, outbox_id):
+        self.conn.execute('UPDATE outbox SET sending = 1 WHERE id = ?', (outbox_id, ))
+        self._autocommit()
+
+    @metrics.timed('db_seconds', call='unsentOutbox')
+    def unsentOutbox(self, outbox_id):
+        self.conn.execute('UPDATE outbox SET sending = 0 WHERE id = ?', (outbox_id, ))
+        self._autocommit()
+
+    @metrics.timed('db_seconds', call='failedOutbox')
+    def failedOutbox(self, outbox_id):
+        self.conn.execute('UPDATE outbox SET attempts = attempts + 1, sending = 0 WHERE id = ?',
+                          (outbox_id, ))
+        self._autocommit()
+
+    @metrics.timed('db_seconds', call='removeSendingOutbox')
+    def removeSendingOutbox(self):
+        """ deletes the items a crash left in sending, returns (id, thing_id, user) of them """
+        rows = self.conn.execute('SELECT id, thing_id, user FROM outbox WHERE sending = 1').fetchall()
+        self.conn.execute('DELETE FROM outbox WHERE sending = 1')
+        self._autocommit()
+        return rows
 
 
     def close(self):
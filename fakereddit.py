@@ -0,0 +1,418 @@
+#!/usr/bin/python
+
+import argparse
+import http.server
+import json
+import logging as log
+import random
+import string
+import threading
+import time
+import urllib.parse
+
+"""
+local http stand-in for the reddit endpoints the bot uses, with latency,
+errors, 429s, rate limits, outages and comment arrival rates.
+start the bot with XWING_REDDIT_URL=http://127.0.0.1:8765 to use it.
+
+    python3 fakereddit.py --port 8765 --comments 30 --latency 0.2 --error-rate 0.01
+
+GET /_stats returns the counters, POST /_control with a json object changes
+the settings of a running server, e.g. {"outage": true} or {"ratelimit_rate": 1}
+"""
+
+CARDS_JSON = 'cards.json'
+words = ('the', 'shot', 'fly', 'ship', 'list', 'tournament', 'dice', 'red', 'focus',
+         'evade', 'turn', 'roll', 'barrel', 'points', 'squad', 'wave')
+# listings reddit returns at most
+max_page = 100
+
+
+class Settings():
+    """ behaviour of the stand-in, all can be changed with /_control """
+
+    def __init__(self, **kwargs):
+        # seconds every request takes, plus up to jitter
+        self.latency = 0.05
+        self.jitter = 0.05
+        # answered with a random 500/502/503
+        self.error_rate = 0.0
+        # answered with 429 too many requests
+        self.throttle_rate = 0.0
+        # comments and messages answered with the RATELIMIT api error
+        self.ratelimit_rate = 0.0
+        self.ratelimit_seconds = 60
+        # everything but the control endpoints is 503
+        self.outage = False
+        # new items per minute
+        self.comments = 10.0
+        self.submissions = 1.0
+        self.messages = 0.5
+        # share of new items asking for a card
+        self.card_rate = 0.3
+        # access tokens expire after that many seconds, praw refreshes them
+        self.token_ttl = 3600
+        # refresh requests answered with 403, the bot falls back to the backup token
+        self.forbid_refresh_rate = 0.0
+        self.username = 'XWingMiniaturesBot'
+        self.subreddit = 'sandboxtest'
+        self.update(**kwargs)
+
+    def update(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise KeyError(key)
+            setattr(self, key, value)
+
+    def asDict(self):
+        return dict(vars(self))
+
+
+def loadNames(path=CARDS_JSON):
+    """ ship and pilot names, the bot knows them all """
+    with open(path, 'r') as infofile:
+        cards = json.load(infofile)
+    return sorted(set(cards['ships']) | set(pilot['name'] for pilot in cards['pilotsById']))
+
+
+class Reddit():
+    """ the items, tokens and counters behind the endpoints """
+
+    def __init__(self, settings, names, seed=None):
+        self.settings = settings
+        self.names = names
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_id = 1
+        # oldest first
+        self.comments = []
+        self.submissions = []
+        # fullname -> message
+        self.unread = {}
+        # fullname -> item data
+        self.things = {}
+        # kind -> next arrival time
+        self.arrivals = {}
+        self.tokens = {}
+        # fullname of items asking for a card -> arrival time
+        self.asking = {}
+        # thing fullname -> first reply time
+        self.answered = {}
+        self.messages_sent = 0
+        self.ratelimited = 0
+        # (path, status) -> count
+        self.requests = {}
+
+    def _id(self):
+        base36 = string.digits + string.ascii_lowercase
+        number = self.next_id
+        self.next_id += 1
+        text = ''
+        while number:
+            number, digit = divmod(number, 36)
+            text = base36[digit] + text
+        return text
+
+    def _text(self, ask):
+        text = ' '.join(self.random.choice(words) for _ in range(self.random.randint(5, 40)))
+        if ask:
+            text += ' [[{}]]'.format(self.random.choice(self.names))
+        return text
+
+    def _newItem(self, kind, now):
+        item_id = self._id()
+        ask = self.random.random() < self.settings.card_rate
+        # one author per item, the pm throttle of the bot never hides an answer
+        author = 'user_' + item_id
+        if kind == 'comments':
+            # own thread for every comment, no duplicate card pms
+            link_id = 't3_' + self._id()
+            data = {'kind': 't1', 'id': item_id, 'name': 't1_' + item_id,
+                    'body': self._text(ask), 'parent_id': link_id, 'link_id': link_id,
+                    'link_title': 'thread ' + link_id, 'author': author,
+                    'subreddit': self.settings.subreddit, 'created_utc': now,
+                    'replies': ''}
+            self.comments.append(data)
+        elif kind == 'submissions':
+            data = {'kind': 't3', 'id': item_id, 'name': 't3_' + item_id,
+                    'title': 'thread ' + item_id, 'selftext': self._text(ask),
+                    'is_self': True, 'author': author, 'subreddit': self.settings.subreddit,
+                    'permalink': '/r/{}/comments/{}/_/'.format(self.settings.subreddit, item_id),
+                    'url': '', 'created_utc': now}
+            self.submissions.append(data)
+        else:
+            data = {'kind': 't4', 'id': item_id, 'name': 't4_' + item_id,
+                    'subject': 'question', 'body': self._text(ask), 'author': author,
+                    'was_comment': False, 'new': True, 'context': '', 'replies': '',
+                    'created_utc': now}
+            self.unread[data['name']] = data
+        self.things[data['name']] = data
+        if ask:
+            self.asking[data['name']] = now
+
+    def arrive(self, now):
+        """ adds the items arrived until now, poisson arrivals at the set rates """
+        for kind in ('comments', 'submissions', 'messages'):
+            rate = getattr(self.settings, kind) / 60
+            if rate <= 0:
+                self.arrivals.pop(kind, None)
+                continue
+            arrival = self.arrivals.get(kind) or now + self.random.expovariate(rate)
+            while arrival <= now:
+                self._newItem(kind, arrival)
+                arrival += self.random.expovariate(rate)
+            self.arrivals[kind] = arrival
+
+    def listing(self, items, params):
+        """
+        newest first, paged with after and limit. before returns the limit
+        items right after it, like reddit nothing for an unknown item
+        """
+        limit = min(max_page, int(params.get('limit', 25)))
+        items = items[::-1]
+        names = [item['name'] for item in items]
+        after = params.get('after')
+        before = params.get('before')
+        if before:
+            newer = items[:names.index(before)] if before in names else []
+            page = newer[-limit:]
+            return {'kind': 'Listing',
+                    'data': {'children': [thing(item) for item in page],
+                             'after': page[-1]['name'] if page else None,
+                             'before': page[0]['name'] if len(newer) > limit else None,
+                             'modhash': ''}}
+        if after:
+            items = items[names.index(after) + 1:] if after in names else []
+        page = items[:limit]
+        return {'kind': 'Listing',
+                'data': {'children': [thing(item) for item in page],
+                         'after': page[-1]['name'] if len(items) > limit else None,
+                         'before': None, 'modhash': ''}}
+
+    def count(self, path, status):
+        key = (path, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def stats(self, now):
+        latencies = sorted(self.answered[name] - self.asking[name]
+                           for name in self.answered if name in self.asking)
+        pick = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+        return {
+            'time': now,
+            'items': len(self.things),
+            'asking': len(self.asking),
+            'answered': len(self.answered),
+            # arrival time of the oldest item still waiting for its answer
+            'oldest_unanswered': min((arrived for name, arrived in self.asking.items()
+                                      if name not in self.answered), default=None),
+            'messages_sent': self.messages_sent,
+            'ratelimited': self.ratelimited,
+            'answer_latency': {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+                               'max': latencies[-1]} if latencies else {},
+            'requests': {'{} {}'.format(path, status): count
+                         for (path, status), count in sorted(self.requests.items())},
+            'settings': self.settings.asDict()
+        }
+
+
+def thing(data):
+    fields = dict(data)
+    return {'kind': fields.pop('kind'), 'data': fields}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # keep-alive, praw reuses its connections
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def _send(self, status, body=None, headers=()):
+        # reddit escapes html in its json, praw unescapes the whole response
+        data = json.dumps(body if body is not None else {})
+        data = data.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _params(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if self.command == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode('utf8')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params['_json'] = json.loads(body or '{}')
+            else:
+                params.update(urllib.parse.parse_qsl(body))
+        path = url.path
+        if path.endswith('.json'):
+            path = path[:-len('.json')]
+        return path.rstrip('/') or '/', params
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        path, params = self._params()
+        reddit = self.server.reddit
+        settings = reddit.settings
+
+        if path == '/_stats':
+            with reddit.lock:
+                reddit.arrive(time.time())
+                return self._send(200, reddit.stats(time.time()))
+        if path == '/_control':
+            try:
+                with reddit.lock:
+                    settings.update(**params.get('_json', {}))
+            except KeyError as e:
+                return self._send(400, {'error': 'unknown setting {}'.format(e)})
+            return self._send(200, settings.asDict())
+
+        time.sleep(settings.latency + reddit.random.random() * settings.jitter)
+        with reddit.lock:
+            status, body, headers = self._answer(reddit, settings, path, params)
+            reddit.count(_route(path), status)
+        self._send(status, body, headers)
+
+    def _answer(self, reddit, settings, path, params):
+        """ status, json body and headers of a request """
+        now = time.time()
+        reddit.arrive(now)
+        chance = reddit.random.random()
+        if settings.outage:
+            return 503, {'error': 503}, ()
+        if chance < settings.error_rate:
+            status = reddit.random.choice((500, 502, 503))
+            return status, {'error': status}, ()
+        if chance < settings.error_rate + settings.throttle_rate:
+            return 429, {'error': 429, 'message': 'Too Many Requests'}, (('Retry-After', '2'), )
+
+        if path == '/api/v1/access_token':
+            if reddit.random.random() < settings.forbid_refresh_rate:
+                return 403, {'error': 403}, ()
+            token = 'token-' + reddit._id()
+            reddit.tokens[token] = now + settings.token_ttl
+            return 200, {'access_token': token, 'token_type': 'bearer',
+                         'expires_in': settings.token_ttl,
+                         'scope': 'identity read submit privatemessages'}, ()
+
+        token = self.headers.get('Authorization', '')[len('bearer '):]
+        if reddit.tokens.get(token, 0) < now:
+            reddit.tokens.pop(token, None)
+            return 401, {'error': 401}, (('www-authenticate', 'Bearer realm="reddit", '
+                                          'error="invalid_token"'), )
+
+        if path == '/api/v1/me':
+            return 200, {'name': settings.username, 'id': 'bot', 'has_mail': False,
+                         'created_utc': 0}, ()
+        if path == '/r/{}/comments'.format(settings.subreddit):
+            return 200, reddit.listing(reddit.comments, params), ()
+        if path == '/r/{}/new'.format(settings.subreddit):
+            return 200, reddit.listing(reddit.submissions, params), ()
+        if path == '/message/unread':
+            return 200, reddit.listing(list(reddit.unread.values()), params), ()
+        if path == '/api/info':
+            names = params.get('id', '').split(',')
+            return 200, reddit.listing([reddit.things[name] for name in names
+                                        if name in reddit.things], {'limit': max_page}), ()
+        if path.startswith('/comments/') or '/comments/' in path:
+            # comment.submission, the thread of a comment
+            link_id = 't3_' + path.split('/comments/')[1].split('/')[0]
+            submission = {'kind': 't3', 'id': link_id[3:], 'name': link_id,
+                          'title': 'thread ' + link_id, 'selftext': '', 'is_self': True,
+                          'permalink': '/comments/{}/_/'.format(link_id[3:]), 'url': '',
+                          'author': 'someone', 'created_utc': now}
+            empty = {'kind': 'Listing', 'data': {'children': [], 'after': None,
+                                                 'before': None, 'modhash': ''}}
+            return 200, [reddit.listing([submission], {}), empty], ()
+        if path == '/api/read_message':
+            for name in params.get('id', '').split(','):
+                reddit.unread.pop(name, None)
+            return 200, {}, ()
+        if path in ('/api/comment', '/api/compose'):
+            if reddit.random.random() < settings.ratelimit_rate:
+                reddit.ratelimited += 1
+                minutes = max(1, settings.ratelimit_seconds // 60)
+                return 200, {'json': {'errors': [['RATELIMIT', 'you are doing that too much. '
+                                                  'try again in {} minutes.'.format(minutes),
+                                                  'ratelimit']],
+                                      'ratelimit': settings.ratelimit_seconds}}, ()
+            if path == '/api/compose':
+                reddit.messages_sent += 1
+                return 200, {'json': {'errors': []}}, ()
+            thing_id = params.get('thing_id')
+            reddit.answered.setdefault(thing_id, now)
+            reply_id = reddit._id()
+            reply = {'kind': 't1', 'id': reply_id, 'name': 't1_' + reply_id,
+                     'body': params.get('text', ''), 'parent_id': thing_id,
+                     'link_id': thing_id, 'author': settings.username,
+                     'created_utc': now, 'replies': ''}
+            return 200, {'json': {'errors': [], 'data': {'things': [thing(reply)]}}}, ()
+        return 404, {'error': 404}, ()
+
+
+def _route(path):
+    """ the path without ids, for the request counters """
+    if '/comments/' in path and not path.endswith('/comments'):
+        return '/comments/{id}'
+    return path
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, reddit):
+        super().__init__(address, Handler)
+        self.reddit = reddit
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+
+def start(settings=None, host='127.0.0.1', port=0, seed=None, names=None):
+    """ serves in a thread, returns the server, see Server.url """
+    reddit = Reddit(settings or Settings(), names or loadNames(), seed)
+    server = Server((host, port), reddit)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    defaults = Settings()
+    arg_parser = argparse.ArgumentParser(description='local stand-in for the reddit api')
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--seed', type=int)
+    for name, value in sorted(defaults.asDict().items()):
+        if isinstance(value, bool):
+            arg_parser.add_argument('--' + name.replace('_', '-'), action='store_true',
+                                    dest=name)
+        else:
+            arg_parser.add_argument('--' + name.replace('_', '-'), type=type(value),
+                                    default=value, dest=name)
+    args = vars(arg_parser.parse_args())
+    host, port, seed = args.pop('host'), args.pop('port'), args.pop('seed')
+
+    log.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=log.INFO)
+    server = Server((host, port), Reddit(Settings(**args), loadNames(), seed))
+    log.info('fake reddit on %s', server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
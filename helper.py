@@ -1,20 +1,38 @@
 
-import io
+import bisect
+import collections
+import concurrent.futures
+import hashlib
 import itertools
 import json
 import logging as log
+import multiprocessing
+import operator
 import re
-import string
+import threading
 import time
 import urllib.parse
 import os
+import pickle
 
 import praw
 
 import credentials
+import metrics
+import spelling
 
 
 reauth_sec = 60*20 # 20 min
+# stand-in for reddit like fakereddit.py, e.g. http://127.0.0.1:8765
+REDDIT_URL = os.environ.get('XWING_REDDIT_URL')
+# seconds between requests for the stand-in, praw waits 2 by default
+REDDIT_DELAY = os.environ.get('XWING_REDDIT_DELAY')
+# texts per poll from which BatchParser uses all cores, unset keeps it in process.
+# only worth it on a multi core machine catching up on a backlog
+PARSE_POOL_SIZE = int(os.environ.get('XWING_PARSE_POOL') or 0)
+# finished replies kept for popular card requests
+reply_cache_size = 256
+suggestion_templ = "No card named *{}*, did you mean {}?\n\n"
 # templates
 signature = ("\n^(Call/)^[PM](https://www.reddit.com/message/compose/?to={})"
             " ^( me with up to 7 [[cardname]] PM [[info]])").format(credentials.username)
@@ -26,13 +44,19 @@ UPGRADE_TEXT_JSON = 'upgrades-en.json'
 MODIFICATION_TEXT_JSON = 'modifications-en.json'
 TITLE_TEXT_JSON = 'titles-en.json'
 INFO_MSG_TMPL = 'info_msg.templ'
+CARD_SNAPSHOT = 'cards.snapshot'
+# bump when the snapshot layout changes
+snapshot_version = 3
 
 
 def initReddit(refresh_token = credentials.refresh_token):
     """ get the reddit api token, see credentials.py for more info """
 
     log.debug("initReddit() creating reddit adapter")
-    r = praw.Reddit(user_agent=credentials.user_agent)
+    if REDDIT_URL:
+        r = _localReddit(REDDIT_URL, REDDIT_DELAY)
+    else:
+        r = praw.Reddit(user_agent=credentials.user_agent)
 
     log.debug("initReddit() preparing reddit adapter")
     r.set_oauth_app_info(client_id=credentials.client_id,
@@ -51,6 +75,19 @@ def initReddit(refresh_token = credentials.refresh_token):
     return r, next_auth_time
 
 
+def _localReddit(url, delay=None):
+    """ praw talking plain http to url for everything, oauth included """
+    log.warning("initReddit() using the reddit stand-in at %s", url)
+    settings = {'check_for_updates': 'false', 'validate_certs': 'false'}
+    if delay is not None:
+        settings['api_request_delay'] = delay
+    r = praw.Reddit(user_agent=credentials.user_agent, disable_update_check=True, **settings)
+    # praw always builds https urls from its domain settings
+    url = url.rstrip('/')
+    r.config.api_url = r.config.permalink_url = r.config.oauth_url = url
+    return r
+
+
 def refreshReddit(r):
     """ keep the reddit api token alive """
     try:
@@ -73,86 +110,443 @@ def refreshReddit(r):
     return r, next_auth_time
 
 
+_notNameRe = re.compile('[^0-9a-z]+')
+
+
 def cleanName(name):
     """ we ignore all special characters, numbers, whitespace, case """
-    return ''.join(char for char in name.lower() if char in (string.digits + string.ascii_lowercase))
+    return _notNameRe.sub('', name.lower())
 
 
-def removeQuotes(text):
-    """ removes quote blocks, the cards in them are already answered """
-    lines = []
-    for l in io.StringIO(text):
-        l = l.strip()
-        if l and l[0] != '>':
-            lines.append(l)
-    return ' '.join(lines)
+class LRUCache():
+    """ bounded dict that drops the least recently used entry """
 
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
 
+    def get(self, key):
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """ hits, misses, size and maxsize for sizing the cache """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class Card():
+    """ one card with its data from the json files, markdown is made on first use """
+    __slots__ = ('kind', 'name', 'unique', 'limited', 'faction', 'ship', 'stats',
+                 'skill', 'points', 'slot', 'slots', 'attack', 'range', 'text',
+                 'actions', 'maneuvers', '_markdown')
+
+    def __init__(self, kind, name, **fields):
+        self.kind = kind
+        self.name = name
+        for field in self.__slots__[2:]:
+            setattr(self, field, fields.get(field))
+
+    def markdown(self):
+        """ formatted card text """
+        if self._markdown is None:
+            self._markdown = _markdown(self)
+        return self._markdown
+
+
+class CardDB():
+    """ cards and aliases by clean name, with a sorted name index for prefix search """
+
+    def __init__(self):
+        self._cards = {}
+        self._aliases = {}
+        self.replies = LRUCache(reply_cache_size)
+        self.reindex()
+
+    @classmethod
+    def fromTexts(cls, texts):
+        """ db of preformatted (name, text) pairs """
+        card_db = cls()
+        for name, text in texts:
+            card_db.add(name, Card('text', name, _markdown=text))
+        card_db.reindex()
+        return card_db
+
+    def add(self, name, card):
+        """ add a card, cards with the same clean name are shown together """
+        self._cards.setdefault(name, []).append(card)
+
+    def alias(self, alias, name):
+        """ alternative name for all cards of name """
+        self._aliases[alias] = name
+
+    def reindex(self):
+        """ rebuild index and caches, call after adding cards """
+        # matches are returned in insertion order, aliases after all cards
+        self._keys = list(self._cards)
+        self._keys.extend(alias for alias in self._aliases if alias not in self._cards)
+        self._order = {name: i for i, name in enumerate(self._keys)}
+        self._names = sorted(self._keys)
+        self._rendered = {}
+        # shorter names are never looked up
+        self.suggester = spelling.Suggester(name for name in self._keys if len(name) > 2)
+        self.replies.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, name):
+        return name in self._order
+
+    def names(self):
+        """ all card names and aliases """
+        return list(self._keys)
+
+    def lookup(self, name):
+        """ cards for a clean name or alias """
+        return self._cards.get(name) or self._cards.get(self._aliases.get(name), [])
+
+    def find(self, prefix):
+        """ all card names starting with prefix """
+        start = bisect.bisect_left(self._names, prefix)
+        # clean names only contain [0-9a-z], '{' sorts after all of them
+        end = bisect.bisect_left(self._names, prefix + '{', start)
+        return sorted(self._names[start:end], key=self._order.__getitem__)
+
+    def text(self, name):
+        """ formatted text of all cards for name """
+        return ''.join(card.markdown() for card in self.lookup(name))
+
+    def rendered(self, name):
+        """ card text with reddit line breaks """
+        rendered = self._rendered.get(name)
+        if rendered is None:
+            rendered = self._rendered[name] = _render(self.text(name))
+        return rendered
+
+
+def _render(text):
+    """ double newlines become markdown line breaks """
+    return text.replace('\n\n', '    \n')
+
+
+@metrics.timed('stage_seconds', stage='getTextForCards')
 def getTextForCards(card_db, cards):
     """ gets card formatted card text and signature and joins them """
-    comment_text = ''
+    key = tuple(cards)
+    comment_text = card_db.replies.get(key)
+    if comment_text is not None:
+        log.debug('cached text for %s', cards)
+        return comment_text
+
+    names = []
+    suggestions = ''
     for card in cards:
         log.info('getting text for %s', card)
-        # Find cards containing the match
-        for name, cardText in card_db.items():
-            if len(card) > 2 and name.startswith(card):
-                comment_text += cardText
+        if len(card) > 2:
+            # Find cards starting with the match
+            found = card_db.find(card)
+            names.extend(found)
+            if not found:
+                similar = card_db.suggester.suggest(card)
+                log.info('no match for %s, suggesting %s', card, similar)
+                if similar:
+                    # display names, an alias and its card are one suggestion
+                    shown = dict.fromkeys(card_db.lookup(name)[0].name for name, score in similar)
+                    suggestions += suggestion_templ.format(card, ', '.join(shown))
 
-    if comment_text:
-        comment_text += signature
+    comment_text = ''
+    if names or suggestions:
+        last = card_db.text(names[-1]) if names else ''
+        # card texts never start with a newline, only the signature can
+        # form a new double newline with the last text
+        comment_text = (''.join(card_db.rendered(name) for name in names[:-1])
+                        + _render(last + suggestions + signature))
+
+    card_db.replies.put(key, comment_text)
+    return comment_text
 
-    comment_text = comment_text.replace('\n\n', '    \n')
 
-    return comment_text
+def answeredCards(card_db, cards):
+    """ the cards getTextForCards shows, the others get suggestions at most """
+    return [card for card in cards if len(card) > 2 and card_db.find(card)]
+
 
+# a single pass over the text: code blocks, code spans and (optionally) quote
+# lines are matched as a whole, so cards inside them are never seen.
+# every alternative is bounded by the line, the fence or 30 chars, which keeps
+# the scan linear even for evil input. a fence opener also ends the text, or
+# a long run of backticks without a newline would backtrack quadratically
+_codePattern = (r'(?P<fence>^[ \t]*(`{3,}|~{3,})[^\n]*(?:\n|\Z).*?(?:^[ \t]*\2|\Z))'
+                r'|(?P<code>`[^`\n]*`)|')
+_cardRe = re.compile(_codePattern + r'\[\[(?P<card>[^\[\]]{1,30})\]',
+                     re.MULTILINE | re.DOTALL)
+# names may still span lines, but not over a quote line
+_cardNoQuotesRe = re.compile(_codePattern + r'(?P<quote>^[^\S\n]*>[^\n]*)'
+                             r'|\[\[(?P<card>(?:[^\[\]\n]|\n(?![^\S\n]*>)){1,30})\]',
+                             re.MULTILINE | re.DOTALL)
 
-def getCardsFromComment(text, spell_check):
-    log.info('getting cards from %s', text)
 
+@metrics.timed('stage_seconds', stage='getCardsFromComment')
+def getCardsFromComment(text, spell_check, ignore_quotes=False):
     """ look for [[cardname]] in text and collect them securely """
+    log.debug('getting cards from %s', text)
+
     cards = []
-    if len(text) < 6:
+    # most comments have no cards, this check is much cheaper than the scan
+    if len(text) < 6 or '[[' not in text:
         return cards
-    open_bracket = False
-    card = ''
-
-    # could be regex, but I rather not parse everything evil users are sending
-    for i in range(1, len(text)):
-        c = text[i]
-        if open_bracket and c != ']':
-            card += c
-        if c == '[' and text[i-1] == '[':
-            open_bracket = True
-        if c == ']' and open_bracket:
-            if len(card) > 0:
-                log.debug("adding a card: %s", card)
-                cleanCard = cleanName(card)
-                if cleanCard:
-                    log.debug("cleaned card name: %s", cleanCard)
-                    # slight spelling error?
-                    # checkedCard = spell_check.correct(cleanCard)
-                    checkedCard = cleanCard
-                    if cleanCard != checkedCard:
-                        log.info("spelling fixed: %s -> %s", cleanCard, checkedCard)
-                    # add cardname
-                    if checkedCard not in cards:
-                        cards.append(checkedCard)
-                    else:
-                        log.info("duplicate card: %s", card)
-
-            card = ''
-            open_bracket = False
-            if len(cards) >= 7:
-                break
-
-        if len(card) > 30:
-            card = ''
-            open_bracket = False
+
+    tokens = _cardNoQuotesRe if ignore_quotes else _cardRe
+    for match in tokens.finditer(text):
+        card = match.group('card')
+        if not card:
+            continue
+
+        log.debug("adding a card: %s", card)
+        cleanCard = cleanName(card)
+        if cleanCard:
+            log.debug("cleaned card name: %s", cleanCard)
+            # slight spelling error? prefixes of names are answered as they are
+            checkedCard = cleanCard
+            if len(cleanCard) > 2 and not spell_check.isPrefix(cleanCard):
+                checkedCard = spell_check.correct(cleanCard)
+            if cleanCard != checkedCard:
+                log.info("spelling fixed: %s -> %s", cleanCard, checkedCard)
+            # add cardname
+            if checkedCard not in cards:
+                cards.append(checkedCard)
+                if len(cards) >= 7:
+                    break
+            else:
+                log.info("duplicate card: %s", card)
 
     log.info('got %i cards', len(cards))
     return cards
 
 
+@metrics.timed('stage_seconds', stage='getCardsFromComments')
+def getCardsFromComments(texts, spell_check, ignore_quotes=False):
+    """ getCardsFromComment for all texts of one poll """
+    return [getCardsFromComment(text, spell_check, ignore_quotes) for text in texts]
+
+
+def _parseTexts(card_db, spell_check, texts, ignore_quotes):
+    found = getCardsFromComments(texts, spell_check, ignore_quotes)
+    return [(cards, getTextForCards(card_db, cards) if cards else None) for cards in found]
+
+
+# cards of a parse worker process, set once when the process starts
+_workerCards = None
+
+def _initParseWorker(card_db, spell_check):
+    global _workerCards
+    _workerCards = (card_db, spell_check)
+
+def _parseChunk(texts, ignore_quotes):
+    card_db, spell_check = _workerCards
+    return _parseTexts(card_db, spell_check, texts, ignore_quotes)
+
+
+class BatchParser():
+    """
+    finds the cards and renders the replies of all texts of a poll.
+    a backlog (pool_size texts or more) is spread over a process pool,
+    smaller batches are faster in process. the pool is closed with the
+    first small batch, catching up is over then. pool_size 0 never uses it
+    """
+
+    def __init__(self, pool_size=0, workers=None, chunk_size=50):
+        self.pool_size = pool_size
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._pool = None
+        # the pool workers got this card db when they started
+        self._pool_cards = None
+
+    def parse(self, card_db, spell_check, texts, ignore_quotes=False):
+        """ (cards, reply text or None) for every text, in order """
+        if not self.pool_size or len(texts) < self.pool_size:
+            self.close()
+            return _parseTexts(card_db, spell_check, texts, ignore_quotes)
+
+        if self._pool_cards is not card_db:
+            self.close()
+            log.info('catching up on %s texts with a process pool', len(texts))
+            self._pool_cards = card_db
+
+        chunks = [texts[i:i + self.chunk_size] for i in range(0, len(texts), self.chunk_size)]
+        try:
+            if not self._pool:
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=_poolContext(),
+                        initializer=_initParseWorker, initargs=(card_db, spell_check))
+            found = self._pool.map(_parseChunk, chunks, itertools.repeat(ignore_quotes))
+            return list(itertools.chain.from_iterable(found))
+        except Exception:
+            log.exception('parse pool failed, parsing in process')
+            self.close()
+            return _parseTexts(card_db, spell_check, texts, ignore_quotes)
+
+    def close(self):
+        if self._pool:
+            self._pool.shutdown()
+        self._pool = None
+        self._pool_cards = None
+
+
+def _poolContext():
+    """
+    the fetch threads are running when the pool starts, a forked worker
+    could inherit a held lock. forkserver and spawn start clean processes
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _sourceFiles():
+    """ the card json files and the code that formats them """
+    return (CARDS_JSON, PILOT_TEXT_JSON, UPGRADE_TEXT_JSON,
+            MODIFICATION_TEXT_JSON, TITLE_TEXT_JSON, __file__, spelling.__file__)
+
+
+def _sourceHash():
+    sha = hashlib.sha256()
+    for path in _sourceFiles():
+        with open(path, 'rb') as infile:
+            sha.update(infile.read())
+    return sha.hexdigest()
+
+
+def spellChecker(card_db):
+    """
+    checker over the names getTextForCards looks up. with the short
+    initialisms [[abc]] would be corrected to ac and get no answer at all
+    """
+    return spelling.Checker(name for name in card_db.names() if len(name) > 2)
+
+
+def loadCards():
+    """ card db and spell checker, from the snapshot if nothing changed """
+    source_hash = _sourceHash()
+    try:
+        with open(CARD_SNAPSHOT, 'rb') as infile:
+            snapshot = pickle.load(infile)
+        if (snapshot['version'] == snapshot_version
+                and snapshot['hash'] == source_hash):
+            log.info('loaded card snapshot %s', CARD_SNAPSHOT)
+            return snapshot['card_db'], snapshot['spell_check']
+        log.info('card snapshot is outdated')
+    except FileNotFoundError:
+        log.info('no card snapshot found')
+    except Exception:
+        log.exception('card snapshot is broken')
+
+    return buildSnapshot(source_hash)
+
+
+def buildSnapshot(source_hash=None):
+    """ rebuild card db and spell checker from json and save the snapshot """
+    card_db = loadCardDB()
+    spell_check = spellChecker(card_db)
+    snapshot = {'version': snapshot_version,
+                'hash': source_hash or _sourceHash(),
+                'card_db': card_db,
+                'spell_check': spell_check}
+
+    try:
+        # never leave a half written snapshot behind
+        with open(CARD_SNAPSHOT + '.tmp', 'wb') as outfile:
+            pickle.dump(snapshot, outfile, pickle.HIGHEST_PROTOCOL)
+        os.replace(CARD_SNAPSHOT + '.tmp', CARD_SNAPSHOT)
+        log.info('saved card snapshot %s', CARD_SNAPSHOT)
+    except OSError:
+        log.exception('saving card snapshot failed')
+
+    return card_db, spell_check
+
+
+class CardReloader():
+    """ rebuilds the cards in a background thread when their files change """
+
+    def __init__(self):
+        self._mtimes = self._sourceMTimes()
+        self._thread = None
+        self._result = None
+
+    @staticmethod
+    def _sourceMTimes():
+        mtimes = []
+        for path in _sourceFiles():
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def _reload(self, changed, old_count):
+        try:
+            self._result = loadCards()
+        except Exception:
+            log.exception('rebuilding cards failed after %i changed files %s, keeping the %i old cards',
+                          len(changed), changed, old_count)
+
+    def poll(self, card_db, spell_check):
+        """ cards to use for the next cycle, never waits for a rebuild """
+        if self._thread:
+            if self._thread.is_alive():
+                return card_db, spell_check
+
+            self._thread = None
+            if self._result:
+                new_db, new_check = self._result
+                self._result = None
+                logCardChanges(card_db, new_db)
+                return new_db, new_check
+
+        mtimes = self._sourceMTimes()
+        if mtimes != self._mtimes:
+            changed = [path for path, old, new in zip(_sourceFiles(), self._mtimes, mtimes)
+                       if old != new]
+            log.info('card files %s changed, rebuilding', changed)
+            self._mtimes = mtimes
+            self._thread = threading.Thread(target=self._reload, args=(changed, len(card_db)),
+                                            daemon=True)
+            self._thread.start()
+
+        return card_db, spell_check
+
+
+def logCardChanges(old_db, new_db):
+    """ log which names were added, removed or changed their text """
+    old_names = set(old_db.names())
+    new_names = set(new_db.names())
+    added = sorted(new_names - old_names)
+    removed = sorted(old_names - new_names)
+    changed = sorted(name for name in old_names & new_names
+                     if old_db.text(name) != new_db.text(name))
+    log.info('card db reloaded: %i added %s, %i removed %s, %i changed %s',
+             len(added), added[:20], len(removed), removed[:20], len(changed), changed[:20])
+
+
 def loadCardDB():
     """ load and format cards from json files into dict """
     with open(CARDS_JSON, 'r') as infofile:
@@ -168,114 +562,132 @@ def loadCardDB():
     return _createCardDB(cards, pilotTexts, upgradeTexts, modificationTexts, titleTexts)
 
 
+def _escape(text):
+    """ parentheses would end reddit's ^(superscript), every word needs its own ^^ """
+    # three C level replaces beat str.translate and re.sub with multi char replacements
+    return text.replace('(', '&#40;').replace(')', '&#41;').replace(' ', ' ^^')
+
+
+def _shipTitle(card):
+    return '{} ({}/{}/{}/{})'.format(card.name, *card.stats)
+
+
+def _pilotShip(card):
+    return '{} ({}/{}/{}/{})'.format(card.ship, *card.stats)
+
+
+# kind: (title, (label, value) lines shown if the value is not None, end)
+_schema = {
+    'ship': (_shipTitle, (), ''),
+    'pilot': (operator.attrgetter('name'),
+              (('Ship', _pilotShip),
+               ('Skill', operator.attrgetter('skill')),
+               ('Points', operator.attrgetter('points'))),
+              '\n\n'),
+    'upgrade': (operator.attrgetter('name'),
+                (('Faction', operator.attrgetter('faction')),
+                 ('Type', operator.attrgetter('slot')),
+                 ('Attack', operator.attrgetter('attack')),
+                 ('Range', operator.attrgetter('range')),
+                 ('Points', operator.attrgetter('points'))),
+                '\n\n'),
+    'modification': (operator.attrgetter('name'),
+                     (('Ship', operator.attrgetter('ship')),
+                      ('Points', operator.attrgetter('points'))),
+                     '\n\n'),
+    'condition': (operator.attrgetter('name'), (), '\n\n'),
+}
+_schema['title'] = _schema['modification']
+
+
+def _markdown(card):
+    """ formats a card by the schema of its kind """
+    title, lines, end = _schema[card.kind]
+    text = '**' + title(card) + '**'
+    if card.unique:
+        text += ' *'
+    text += '\n\r\n'
+    if card.limited:
+        text += '^^*limited*\n\n'
+
+    # the lines are escaped all at once
+    body = ''
+    for label, field in lines:
+        value = field(card)
+        if value is not None:
+            body += '^^{}: {}\n\n'.format(label, value)
+    if card.text is not None:
+        body += '^^' + card.text + '\n\n'
+    return text + _escape(body) + end
+
+
+def _stats(ship):
+    return (ship.get('attack') or 0, ship['agility'], ship['hull'], ship['shields'])
+
+
+def _cardFields(data, texts):
+    """ the card data we keep, the text is looked up by name """
+    fields = {field: data.get(field) for field in
+              ('faction', 'ship', 'skill', 'points', 'slot', 'slots', 'attack', 'range', 'actions')}
+    fields['unique'] = 'unique' in data
+    fields['limited'] = 'limited' in data
+    text = texts.get(data['name'].replace('"',''))
+    if text is not None:
+        fields['text'] = text['text']
+    return fields
+
+
 def _createCardDB(cards, pilotTexts, upgradeTexts, modificationTexts, titleTexts):
-    """ formats all the cards to text """
-    # TODO cardDB should be an object by now instead of a dict
-    card_db = {}
-    initialisms_db = {}
-    ship_db = {}
+    """ collects all cards and their texts """
+    card_db = CardDB()
+    ship_stats = {}
 
     for name, ship in cards['ships'].items():
-        ship_db[name] = '{} ({}/{}/{}/{})'.format(name, ship.get('attack') or 0, ship['agility'], ship['hull'], ship['shields'])
-        card_db[cleanName(name)] = '**' + ship_db[name] + '**\n\r\n'
+        ship_stats[name] = _stats(ship)
+        card_db.add(cleanName(name), Card('ship', name, stats=ship_stats[name],
+                                          actions=ship.get('actions'),
+                                          maneuvers=ship.get('maneuvers')))
 
-    # fill templates
     for pilot in cards['pilotsById']:
-        if not cleanName(pilot['name']) in card_db:
-            card_db[cleanName(pilot['name'])] = ''
-        card_db[cleanName(pilot['name'])] += '**' + '{}'.format(pilot['name']) + '**'
-        if 'unique' in pilot:
-            card_db[cleanName(pilot['name'])] += ' *'
-        card_db[cleanName(pilot['name'])] += '\n\r\n'
-        if 'limited' in pilot:
-            card_db[cleanName(pilot['name'])] += '^^*limited*\n\n'
+        fields = _cardFields(pilot, pilotTexts)
         if 'ship_override' in pilot:
-            card_db[cleanName(pilot['name'])] += '^^Ship: {} ({}/{}/{}/{})'.format(pilot['ship'], pilot['ship_override'].get('attack') or 0, pilot['ship_override']['agility'], pilot['ship_override']['hull'], pilot['ship_override']['shields']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^') + '\n\n'
+            fields['stats'] = _stats(pilot['ship_override'])
         else:
-            card_db[cleanName(pilot['name'])] += ('^^Ship: {}\n\n'.format(ship_db[pilot['ship']])).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        card_db[cleanName(pilot['name'])] += '^^Skill: {}\n\n^^Points: {}\n\n'.format(pilot['skill'], pilot['points']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        if pilot['name'].replace('"','') in pilotTexts:
-            card_db[cleanName(pilot['name'])] += ('^^' + pilotTexts[pilot['name'].replace('"','')]['text'] + '\n\n').replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        card_db[cleanName(pilot['name'])] += '\n\n'
-        log.info('Added %s', card_db[cleanName(pilot['name'])])
-
-    for upgrade in cards['upgradesById']:
-        if not cleanName(upgrade['name']) in card_db:
-            card_db[cleanName(upgrade['name'])] = ''
-        card_db[cleanName(upgrade['name'])] += '**' + '{}'.format(upgrade['name']) + '**'
-        if 'unique' in upgrade:
-            card_db[cleanName(upgrade['name'])] += ' *'
-        card_db[cleanName(upgrade['name'])] += '\n\r\n'
-        if 'limited' in upgrade:
-            card_db[cleanName(upgrade['name'])] += '^^*limited*\n\n'
-        if 'faction' in upgrade:
-            card_db[cleanName(upgrade['name'])] += '^^Faction: {}\n\n'.format(upgrade['faction']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        if 'slot' in upgrade:
-            card_db[cleanName(upgrade['name'])] += '^^Type: {}\n\n'.format(upgrade['slot']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        if 'attack' in upgrade:
-            card_db[cleanName(upgrade['name'])] += '^^Attack: {}\n\n'.format(upgrade['attack']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        if 'range' in upgrade:
-            card_db[cleanName(upgrade['name'])] += '^^Range: {}\n\n'.format(upgrade['range']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        if 'points' in upgrade:
-            card_db[cleanName(upgrade['name'])] += '^^Points: {}\n\n'.format(upgrade['points']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        if upgrade['name'].replace('"','') in upgradeTexts:
-            card_db[cleanName(upgrade['name'])] += ('^^' + upgradeTexts[upgrade['name'].replace('"','')]['text'] + '\n\n').replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        card_db[cleanName(upgrade['name'])] += '\n\n'
-        log.info('Added %s', card_db[cleanName(upgrade['name'])])
-
-    for modification in cards['modificationsById']:
-        if not cleanName(modification['name']) in card_db:
-            card_db[cleanName(modification['name'])] = ''
-        card_db[cleanName(modification['name'])] += '**' + '{}'.format(modification['name']) + '**'
-        if 'unique' in modification:
-            card_db[cleanName(modification['name'])] += ' *'
-        card_db[cleanName(modification['name'])] += '\n\r\n'
-        if 'limited' in modification:
-            card_db[cleanName(modification['name'])] += '^^*limited*\n\n'
-        if 'ship' in modification:
-            card_db[cleanName(modification['name'])] += '^^Ship: {}\n\n'.format(modification['ship']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        if 'points' in modification:
-            card_db[cleanName(modification['name'])] += '^^Points: {}\n\n'.format(modification['points']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        if modification['name'].replace('"','') in modificationTexts:
-            card_db[cleanName(modification['name'])] += ('^^' + modificationTexts[modification['name'].replace('"','')]['text'] + '\n\n').replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        card_db[cleanName(modification['name'])] += '\n\n'
-        log.info('Added %s', card_db[cleanName(modification['name'])])
-
-    for titleText in cards['titlesById']:
-        if not cleanName(titleText['name']) in card_db:
-            card_db[cleanName(titleText['name'])] = ''
-        card_db[cleanName(titleText['name'])] += '**' + '{}'.format(titleText['name']) + '**'
-        if 'unique' in titleText:
-            card_db[cleanName(titleText['name'])] += ' *'
-        card_db[cleanName(titleText['name'])] += '\n\r\n'
-        if 'limited' in titleText:
-            card_db[cleanName(titleText['name'])] += '^^*limited*\n\n'
-        if 'ship' in titleText:
-            card_db[cleanName(titleText['name'])] += '^^Ship: {}\n\n'.format(titleText['ship']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        if 'points' in titleText:
-            card_db[cleanName(titleText['name'])] += '^^Points: {}\n\n'.format(titleText['points']).replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        if titleText['name'].replace('"','') in titleTexts:
-            card_db[cleanName(titleText['name'])] += ('^^' + titleTexts[titleText['name'].replace('"','')]['text'] + '\n\n').replace('(','&#40;').replace('(','&#41;').replace(' ',' ^^')
-        card_db[cleanName(titleText['name'])] += '\n\n'
-        log.info('Added %s', card_db[cleanName(titleText['name'])])
+            fields['stats'] = ship_stats[pilot['ship']]
+        card_db.add(cleanName(pilot['name']), Card('pilot', pilot['name'], **fields))
+
+    for kind, key, texts in (('upgrade', 'upgradesById', upgradeTexts),
+                             ('modification', 'modificationsById', modificationTexts),
+                             ('title', 'titlesById', titleTexts)):
+        for card in cards.get(key, ()):
+            card_db.add(cleanName(card['name']), Card(kind, card['name'], **_cardFields(card, texts)))
+
+    # there is no text file for conditions, a bare title is no answer.
+    # id 0 is a placeholder
+    for condition in cards.get('conditionsById', ()):
+        if condition.get('id') == 0 or condition.get('skip') or not condition.get('text'):
+            continue
+        fields = _cardFields(condition, {})
+        fields['text'] = condition['text']
+        card_db.add(cleanName(condition['name']), Card('condition', condition['name'], **fields))
 
     # Create initialisms
-    for upgrade in cards['upgradesById']:
-        if len(upgrade['name'].split()) > 1:
-            log.info('Adding %s initialism for %s', cleanName(''.join(title[0] for title in upgrade['name'].split())), upgrade['name'])
-            initialisms_db[cleanName(''.join(title[0] for title in upgrade['name'].split()))] = card_db[cleanName(upgrade['name'])]
-
-    for modification in cards['modificationsById']:
-        if len(modification['name'].split()) > 1:
-            log.info('Adding %s initialism for %s', cleanName(''.join(title[0] for title in modification['name'].split())), modification['name'])
-            initialisms_db[cleanName(''.join(title[0] for title in modification['name'].split()))] = card_db[cleanName(modification['name'])]
-
-    for titleText in cards['titlesById']:
-        if len(titleText['name'].split()) > 1:
-            log.info('Adding %s initialism for %s', cleanName(''.join(title[0] for title in titleText['name'].split())), titleText['name'])
-            initialisms_db[cleanName(''.join(title[0] for title in titleText['name'].split()))] = card_db[cleanName(titleText['name'])]
+    for key in ('upgradesById', 'modificationsById', 'titlesById'):
+        for card in cards[key]:
+            if len(card['name'].split()) > 1:
+                initialism = cleanName(''.join(title[0] for title in card['name'].split()))
+                log.debug('Adding %s initialism for %s', initialism, card['name'])
+                card_db.alias(initialism, cleanName(card['name']))
+
+    card_db.reindex()
+    log.info('Added %i cards', len(card_db))
+    return card_db
 
-    for name, text in initialisms_db.items():
-        card_db[name] = text
 
-    return card_db
+if __name__ == "__main__":
+    # compile the card snapshot ahead of the bot start
+    log.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                    level=log.INFO)
+    # the pickle must name the classes helper.CardDB, not __main__.CardDB
+    import helper
+    helper.buildSnapshot()
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import logging as log
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import credentials
+import fakereddit
+import helper
+
+"""
+runs the bot against fakereddit.py through phases of normal load, an outage
+and rate limiting. reports the answers per minute of every phase and how long
+the bot needed to answer everything that arrived before an incident ended.
+
+    python3 loadtest.py --comments 30 --steady 300 --outage 120 --throttle 120
+
+the bot runs in its own process in a temp dir, its log is saved next to the report
+"""
+
+bot_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xwingmini-bot.py')
+# files the bot reads from its working dir
+bot_files = (helper.CARDS_JSON, helper.PILOT_TEXT_JSON, helper.UPGRADE_TEXT_JSON,
+             helper.MODIFICATION_TEXT_JSON, helper.TITLE_TEXT_JSON, helper.INFO_MSG_TMPL)
+
+
+def phases(args):
+    """ (name, seconds, settings, incident), every incident is followed by a recovery """
+    planned = [('steady', args.steady, {}, False)]
+    if args.outage:
+        planned.append(('outage', args.outage, {'outage': True}, True))
+        planned.append(('recover_outage', args.recover, {'outage': False}, False))
+    if args.throttle:
+        planned.append(('throttle', args.throttle, {'ratelimit_rate': 1.0,
+                                                    'throttle_rate': args.throttle_rate}, True))
+        planned.append(('recover_throttle', args.recover,
+                        {'ratelimit_rate': args.ratelimit_rate, 'throttle_rate': 0.0}, False))
+    return planned
+
+
+def startBot(server, work_dir, request_delay):
+    for name in bot_files:
+        if os.path.exists(name):
+            os.symlink(os.path.abspath(name), os.path.join(work_dir, name))
+    env = dict(os.environ, XWING_REDDIT_URL=server.url)
+    if request_delay is not None:
+        env['XWING_REDDIT_DELAY'] = str(request_delay)
+    bot_log = open(os.path.join(work_dir, 'bot.log'), 'w')
+    return subprocess.Popen([sys.executable, bot_script], cwd=work_dir, env=env,
+                            stdout=bot_log, stderr=subprocess.STDOUT)
+
+
+def stopBot(bot, work_dir):
+    """ the lockfile stops the bot after its cycle, a long sleep is cut short """
+    lockfile = os.path.join(work_dir, 'lockfile.lock')
+    if os.path.isfile(lockfile):
+        os.remove(lockfile)
+    try:
+        bot.wait(10)
+    except subprocess.TimeoutExpired:
+        bot.terminate()
+        bot.wait()
+
+
+def summarize(reddit, name, start, end):
+    """ throughput and answer latency of the items arrived in start..end """
+    arrived = [fullname for fullname, created in reddit.asking.items() if start <= created < end]
+    answered_in = [fullname for fullname, answered in reddit.answered.items()
+                   if start <= answered < end]
+    latencies = sorted(reddit.answered[fullname] - reddit.asking[fullname]
+                       for fullname in arrived if fullname in reddit.answered)
+    minutes = (end - start) / 60
+    pick = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+    return {
+        'phase': name,
+        'seconds': end - start,
+        'asking': len(arrived),
+        'answered': len(answered_in),
+        'asking_per_minute': len(arrived) / minutes,
+        'answers_per_minute': len(answered_in) / minutes,
+        'unanswered': len(arrived) - len(latencies),
+        'answer_latency': {'p50': pick(0.5), 'p90': pick(0.9), 'max': latencies[-1]}
+                          if latencies else {}
+    }
+
+
+def recoveryTime(reddit, incident_end):
+    """ seconds after incident_end until all items arrived before it were answered """
+    waiting = [fullname for fullname, created in reddit.asking.items() if created < incident_end]
+    if any(fullname not in reddit.answered for fullname in waiting):
+        return None
+    last = max((reddit.answered[fullname] for fullname in waiting), default=incident_end)
+    return max(0, last - incident_end)
+
+
+def run(args):
+    settings = fakereddit.Settings(
+            comments=args.comments, submissions=args.submissions, messages=args.messages,
+            card_rate=args.card_rate, latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate, ratelimit_rate=args.ratelimit_rate,
+            ratelimit_seconds=args.ratelimit_seconds, token_ttl=args.token_ttl,
+            username=credentials.username, subreddit='+'.join(credentials.subreddits))
+    server = fakereddit.start(settings, seed=args.seed)
+    reddit = server.reddit
+    work_dir = tempfile.mkdtemp(prefix='loadtest-')
+    log.info('fake reddit on %s, bot in %s', server.url, work_dir)
+
+    bot = startBot(server, work_dir, args.request_delay)
+    report = {'settings': settings.asDict(), 'phases': [], 'recovery_seconds': {}}
+    # (name, start, end) of the phases so far
+    windows = []
+    incidents = []
+    try:
+        for name, seconds, changes, incident in phases(args):
+            with reddit.lock:
+                settings.update(**changes)
+            start = time.time()
+            log.info('%s for %s s: %s', name, seconds, changes or 'no changes')
+            while time.time() < start + seconds:
+                if bot.poll() is not None:
+                    raise Exception('bot exited with {}, see {}'.format(
+                            bot.returncode, os.path.join(work_dir, 'bot.log')))
+                time.sleep(max(0, min(args.sample, start + seconds - time.time())))
+                with reddit.lock:
+                    stats = reddit.stats(time.time())
+                    for past, past_end in incidents:
+                        if past not in report['recovery_seconds']:
+                            recovered = recoveryTime(reddit, past_end)
+                            if recovered is not None:
+                                report['recovery_seconds'][past] = recovered
+                log.info('%s: %s asking, %s answered, oldest waiting since %s s', name,
+                         stats['asking'], stats['answered'],
+                         round(time.time() - stats['oldest_unanswered'])
+                         if stats['oldest_unanswered'] else '-')
+            windows.append((name, start, time.time()))
+            if incident:
+                incidents.append((name, time.time()))
+    finally:
+        stopBot(bot, work_dir)
+
+    with reddit.lock:
+        # answers of a phase can arrive in the next ones
+        report['phases'] = [summarize(reddit, name, start, end) for name, start, end in windows]
+        for incident, incident_end in incidents:
+            if incident not in report['recovery_seconds']:
+                # None: not everything was answered by the end of the test
+                report['recovery_seconds'][incident] = recoveryTime(reddit, incident_end)
+        report['totals'] = reddit.stats(time.time())
+    server.shutdown()
+
+    shutil.copy(os.path.join(work_dir, 'bot.log'), args.output + '.bot.log')
+    shutil.rmtree(work_dir)
+    with open(args.output, 'w', newline='\n') as f:
+        json.dump(report, f, sort_keys=True, indent=2)
+
+    for phase in report['phases']:
+        print('{phase:18} {asking_per_minute:8.1f} asking/min {answers_per_minute:8.1f} '
+              'answers/min {unanswered:5} unanswered'.format(**phase))
+    for incident, seconds in sorted(report['recovery_seconds'].items()):
+        print('recovered from {:10} {}'.format(
+                incident, 'in {:.0f} s'.format(seconds) if seconds is not None else 'never'))
+    print('saved', args.output)
+    return 0 if all(seconds is not None for seconds in report['recovery_seconds'].values()) else 1
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='load test of the bot against fakereddit.py')
+    arg_parser.add_argument('-o', '--output', default='loadtest.json')
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--sample', type=float, default=10,
+                            help='seconds between progress lines (10)')
+    arg_parser.add_argument('--request-delay', type=float,
+                            help='seconds praw waits between requests (praw default)')
+    # phases, 0 skips an incident
+    arg_parser.add_argument('--steady', type=float, default=300)
+    arg_parser.add_argument('--outage', type=float, default=120)
+    arg_parser.add_argument('--throttle', type=float, default=120)
+    arg_parser.add_argument('--recover', type=float, default=600,
+                            help='seconds after each incident, the bot polls a quiet '
+                            'source every 600 s (600)')
+    # load and behaviour of the stand-in, see fakereddit.Settings
+    arg_parser.add_argument('--comments', type=float, default=30, help='per minute (30)')
+    arg_parser.add_argument('--submissions', type=float, default=2, help='per minute (2)')
+    arg_parser.add_argument('--messages', type=float, default=1, help='per minute (1)')
+    arg_parser.add_argument('--card-rate', type=float, default=0.3)
+    arg_parser.add_argument('--latency', type=float, default=0.2)
+    arg_parser.add_argument('--jitter', type=float, default=0.2)
+    arg_parser.add_argument('--error-rate', type=float, default=0.01)
+    arg_parser.add_argument('--ratelimit-rate', type=float, default=0.0,
+                            help='share of sends rate limited outside the throttle phase')
+    arg_parser.add_argument('--ratelimit-seconds', type=int, default=60)
+    arg_parser.add_argument('--throttle-rate', type=float, default=0.2,
+                            help='share of 429s in the throttle phase (0.2)')
+    arg_parser.add_argument('--token-ttl', type=int, default=3600)
+    args = arg_parser.parse_args()
+
+    log.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=log.INFO)
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
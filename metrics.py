@@ -0,0 +1,144 @@
+import bisect
+import functools
+import os
+import threading
+import time
+
+
+"""
+counters, gauges and latency histograms of the bot, written in the
+prometheus text format for the node_exporter textfile collector:
+https://github.com/prometheus/node_exporter#textfile-collector
+"""
+
+prefix = 'xwingminibot_'
+# upper bounds in seconds, from a cached seen check to a slow reddit call
+buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+# fetches run in threads, everything is changed under the lock
+_lock = threading.Lock()
+# (name, labels) -> value
+_counters = {}
+_gauges = {}
+# (name, labels) -> [count per bucket..., count above, sum]
+_histograms = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def count(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def _observe(key, seconds):
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(buckets) + 2)
+        histogram[bisect.bisect_left(buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+
+def observe(name, seconds, **labels):
+    _observe(_key(name, labels), seconds)
+
+
+class timed():
+    """ times a with block or every call of a decorated function """
+
+    def __init__(self, name, **labels):
+        self.key = _key(name, labels)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _observe(self.key, time.perf_counter() - self.start)
+        return False
+
+    def __call__(self, func):
+        key = self.key
+
+        @functools.wraps(func)
+        def timedFunc(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _observe(key, time.perf_counter() - start)
+        return timedFunc
+
+
+def sums(name):
+    """ labels -> total seconds of histogram name, e.g. to diff two points in time """
+    with _lock:
+        return {labels: values[-1] for (key_name, labels), values in _histograms.items()
+                if key_name == name}
+
+
+def clear():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _labels(labels, extra=()):
+    labels = labels + extra
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join('{}="{}"'.format(name, value)
+                          for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def render():
+    """ all metrics in the prometheus text format """
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+
+    lines = []
+    typed = set()
+    def addType(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {}{} {}'.format(prefix, name, kind))
+
+    for (name, labels), value in counters:
+        addType(name, 'counter')
+        lines.append('{}{}{} {}'.format(prefix, name, _labels(labels), value))
+    for (name, labels), value in gauges:
+        addType(name, 'gauge')
+        lines.append('{}{}{} {}'.format(prefix, name, _labels(labels), value))
+    for (name, labels), values in histograms:
+        addType(name, 'histogram')
+        cumulative = 0
+        for bound, bucket_count in zip(buckets + ('+Inf', ), values):
+            cumulative += bucket_count
+            lines.append('{}{}_bucket{} {}'.format(prefix, name,
+                                                  _labels(labels, (('le', bound), )),
+                                                  cumulative))
+        lines.append('{}{}_sum{} {}'.format(prefix, name, _labels(labels), values[-1]))
+        lines.append('{}{}_count{} {}'.format(prefix, name, _labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def writeTextfile(path):
+    """ replaces path at once, the collector never reads half a file """
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='\n') as f:
+        f.write(render())
+    os.replace(tmp, path)
@@ -0,0 +1,163 @@
+import logging as log
+import time
+
+import praw
+import requests
+
+import metrics
+
+
+def _isOutage(error):
+    """ reddit or the connection is down, the item itself is fine """
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    # praw keeps the response in _raw, requests in response
+    response = getattr(error, '_raw', None)
+    if response is None:
+        response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return isinstance(status, int) and (status >= 500 or status == 429)
+
+
+class TokenBucket():
+    """
+    allows rate sends per second on average and bursts of up to capacity.
+    reddit allows 60 requests per minute, the default leaves half for reading
+    """
+
+    def __init__(self, rate = 0.5, capacity = 5):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        # no tokens are handed out before this
+        self.paused_until = 0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now = None):
+        """ true and uses a token if one is available """
+        now = now or time.time()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait(self, now = None):
+        """ seconds until the next token """
+        now = now or time.time()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def pause(self, seconds, now = None):
+        """ nothing for seconds, then start with an empty bucket """
+        now = now or time.time()
+        self.paused_until = now + seconds
+        self.tokens = 0
+        self.updated = self.paused_until
+
+
+class Outbox():
+    """
+    replies and pms are queued in the db and sent when the bucket allows.
+    a rate limit pauses sending only, reading goes on and nothing queued is lost.
+    an item is marked as sending before it goes out, one still marked after
+    a crash may be on reddit already and is dropped, never sent twice.
+    an outage pauses sending with a growing backoff, only errors of the item
+    itself count as attempts
+    """
+
+    def __init__(self, db, bucket = None, max_attempts = 3, min_backoff = 10, max_backoff = 300):
+        self.db = db
+        self.bucket = bucket or TokenBucket()
+        self.max_attempts = max_attempts
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        # seconds of the last outage pause, 0 after a successful send
+        self.backoff = 0
+        for outbox_id, thing_id, user in db.removeSendingOutbox():
+            log.warning('dropping %s to %s, it was being sent when the bot stopped',
+                        outbox_id, thing_id or user)
+            metrics.count('replies_total', result='dropped')
+
+    def __len__(self):
+        return self.db.outboxSize()
+
+    def reply(self, thing, text):
+        """ queue a reply to a comment, submission or message """
+        self.db.queueReply(thing.fullname, text)
+
+    def message(self, user, subject, text):
+        """ queue a pm, user is a name or a Redditor """
+        self.db.queueMessage(str(user), subject, text)
+
+    def wait(self):
+        """ seconds until the next send is possible, None if nothing is queued """
+        if not self.db.outboxSize():
+            return None
+        return self.bucket.wait()
+
+    def _send(self, r, thing_id, user, subject, body):
+        if thing_id:
+            # Comment.reply, Submission.add_comment and Message.reply all are
+            # this call, the fullname is all we need to send after a restart
+            with metrics.timed('reply_seconds', kind='reply'):
+                r._add_comment(thing_id, body)
+        else:
+            with metrics.timed('reply_seconds', kind='message'):
+                r.send_message(user, subject, body)
+
+    def send(self, r):
+        """ sends queued items while tokens last, returns the number sent """
+        sent = 0
+        for outbox_id, thing_id, user, subject, body, attempts in self.db.outbox():
+            if not self.bucket.take():
+                break
+            # on disk before the send, a crash during it must not repeat it
+            self.db.sendingOutbox(outbox_id)
+            self.db.commit()
+            try:
+                log.debug('sending %s to %s', outbox_id, thing_id or user)
+                self._send(r, thing_id, user, subject, body)
+            except praw.errors.RateLimitExceeded as rle:
+                # happens a lot for accounts without email, <10 days old and some points
+                log.warning('rate exceeded, sending nothing for %s s', rle.sleep_time)
+                metrics.count('replies_total', result='ratelimited')
+                self.bucket.pause(rle.sleep_time)
+                self.db.unsentOutbox(outbox_id)
+                self.db.commit()
+                break
+            except Exception as error:
+                if _isOutage(error):
+                    self.backoff = min(self.max_backoff, self.backoff * 2 or self.min_backoff)
+                    log.warning('sending %s failed, reddit is unreachable, sending nothing for %s s: %r',
+                                outbox_id, self.backoff, error)
+                    metrics.count('replies_total', result='deferred')
+                    self.bucket.pause(self.backoff)
+                    self.db.unsentOutbox(outbox_id)
+                    self.db.commit()
+                    break
+                if attempts + 1 < self.max_attempts:
+                    log.exception('sending %s failed, will retry', outbox_id)
+                    metrics.count('replies_total', result='failed')
+                    self.db.failedOutbox(outbox_id)
+                else:
+                    log.exception('sending %s failed, giving up: %s', outbox_id, body)
+                    metrics.count('replies_total', result='dropped')
+                    self.db.removeOutbox(outbox_id)
+            else:
+                self.backoff = 0
+                metrics.count('replies_total', result='sent')
+                self.db.removeOutbox(outbox_id)
+                sent += 1
+            # every send is on reddit now, a restart must not repeat it
+            self.db.commit()
+        return sent
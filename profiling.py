@@ -0,0 +1,117 @@
+import cProfile
+import contextlib
+import logging as log
+import os
+import os.path
+import time
+import tracemalloc
+
+import metrics
+
+
+"""
+opt in profiling of the poll cycles, see Profiler.fromEnv for the switches.
+disabled it is a single attribute check per cycle
+"""
+
+# histograms that make up the stage breakdown of a slow cycle
+breakdown_metrics = ('stage_seconds', 'db_seconds', 'reply_seconds')
+
+
+class Profiler():
+    """
+    profile_cycles: cProfile that many cycles (main thread), one pstats file each
+    memory_every: tracemalloc snapshot every that many cycles, logs the growth
+    slow_cycle: log cycles slower than that many seconds with their stages
+    sizes: function returning a dict of sizes logged with every snapshot
+    """
+
+    def __init__(self, profile_cycles=0, memory_every=0, slow_cycle=0,
+                 out_dir='profile', sizes=None):
+        self.profile_cycles = profile_cycles
+        self.memory_every = memory_every
+        self.slow_cycle = slow_cycle
+        self.out_dir = out_dir
+        self.sizes = sizes
+        self.enabled = bool(profile_cycles or memory_every or slow_cycle)
+        self.cycles = 0
+        self._snapshot = None
+
+        if profile_cycles or memory_every:
+            os.makedirs(out_dir, exist_ok=True)
+        if memory_every:
+            tracemalloc.start()
+
+    @classmethod
+    def fromEnv(cls, environ=os.environ, **kwargs):
+        """
+        XWING_PROFILE_CYCLES, XWING_MEMORY_EVERY, XWING_SLOW_CYCLE and
+        XWING_PROFILE_DIR, keyword arguments (e.g. from the command line) win
+        """
+        settings = {
+            'profile_cycles': int(environ.get('XWING_PROFILE_CYCLES', 0)),
+            'memory_every': int(environ.get('XWING_MEMORY_EVERY', 0)),
+            'slow_cycle': float(environ.get('XWING_SLOW_CYCLE', 0)),
+            'out_dir': environ.get('XWING_PROFILE_DIR', 'profile')
+        }
+        settings.update((key, value) for key, value in kwargs.items() if value)
+        return cls(**settings)
+
+    def cycle(self):
+        """ context manager around one poll cycle """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._profileCycle()
+
+    @contextlib.contextmanager
+    def _profileCycle(self):
+        self.cycles += 1
+        profile = None
+        if self.cycles <= self.profile_cycles:
+            profile = cProfile.Profile()
+        stages = {name: metrics.sums(name) for name in breakdown_metrics}
+        start = time.perf_counter()
+
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            duration = time.perf_counter() - start
+
+            if profile:
+                path = os.path.join(self.out_dir, 'cycle-{}.pstats'.format(self.cycles))
+                profile.dump_stats(path)
+                log.info('profiled cycle %s: %s', self.cycles, path)
+            if self.slow_cycle and duration > self.slow_cycle:
+                log.warning('slow cycle %s: %.2f s, %s', self.cycles, duration,
+                            self._breakdown(stages))
+            if self.memory_every and self.cycles % self.memory_every == 0:
+                self._compareMemory()
+
+    def _breakdown(self, before):
+        """ seconds per stage since before, slowest first """
+        spent = []
+        for name in breakdown_metrics:
+            for labels, total in metrics.sums(name).items():
+                seconds = total - before[name].get(labels, 0)
+                if seconds > 0.001:
+                    label = ','.join(str(value) for _, value in labels)
+                    spent.append(('{}[{}]'.format(name, label), seconds))
+        spent.sort(key=lambda stage: -stage[1])
+        return ', '.join('{} {:.3f}'.format(stage, seconds) for stage, seconds in spent)
+
+    def _compareMemory(self):
+        snapshot = tracemalloc.take_snapshot()
+        path = os.path.join(self.out_dir, 'memory-{}.snapshot'.format(self.cycles))
+        snapshot.dump(path)
+
+        current, peak = tracemalloc.get_traced_memory()
+        log.info('memory at cycle %s: %.1f MB, peak %.1f MB, %s, %s', self.cycles,
+                 current / 1e6, peak / 1e6, self.sizes() if self.sizes else '', path)
+        if self._snapshot:
+            for stat in snapshot.compare_to(self._snapshot, 'lineno')[:10]:
+                log.info('memory growth: %s', stat)
+        self._snapshot = snapshot
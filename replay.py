@@ -0,0 +1,339 @@
+#!/usr/bin/python
+
+import argparse
+import collections
+import json
+import logging as log
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+import commentDB
+import helper
+import metrics
+import outbox
+import throttle
+
+bot = __import__("xwingmini-bot")
+
+"""
+captures reddit items to jsonl and replays them through the bot offline.
+replay runs the fetch and answer functions of the bot against a fake reddit
+and reports items per second, reply latency and sqlite writes per item.
+
+    python3 replay.py capture -o capture.jsonl
+    python3 replay.py run capture.jsonl --save-replies replies.jsonl
+    python3 replay.py run capture.jsonl --expect replies.jsonl
+"""
+
+# fields of the captured items, see toJson
+comment_fields = ('id', 'fullname', 'created_utc', 'body', 'parent_id')
+submission_fields = ('id', 'fullname', 'created_utc', 'selftext', 'is_self')
+message_fields = ('id', 'fullname', 'created_utc', 'body', 'subject', 'was_comment')
+
+
+def toJson(kind, item):
+    fields = {'comment': comment_fields, 'submission': submission_fields,
+              'message': message_fields}[kind]
+    data = {field: getattr(item, field) for field in fields}
+    data['kind'] = kind
+    data['author'] = item.author.name if item.author else None
+    if kind == 'comment':
+        # comment.submission would be one request per comment
+        data['link_title'] = getattr(item, 'link_title', '')
+        data['link_permalink'] = getattr(item, 'link_permalink', None) or \
+                'https://www.reddit.com/comments/' + item.link_id[3:]
+    return data
+
+
+def capture(args):
+    """ reads the listings of the bot once, unread messages stay unread """
+    r, _ = helper.initReddit()
+    listings = (
+        ('comment', r.get_subreddit(bot.SUBS_STRING).get_comments(limit=args.limit)),
+        ('submission', r.get_subreddit(bot.SUBS_STRING).get_new(limit=args.limit)),
+        ('message', r.get_unread(limit=args.limit))
+    )
+    items = []
+    for kind, listing in listings:
+        found = [toJson(kind, item) for item in listing]
+        log.info('captured %s %ss', len(found), kind)
+        items.extend(found)
+
+    # oldest first, replay delivers them in that order
+    items.sort(key=lambda item: item['created_utc'])
+    with open(args.output, 'w', newline='\n') as f:
+        for item in items:
+            f.write(json.dumps(item, sort_keys=True) + '\n')
+    log.info('saved %s items to %s', len(items), args.output)
+
+
+class FakeAuthor():
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeThing():
+    """ comment, submission or message with the attributes the bot reads """
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+        self.author = FakeAuthor(data['author']) if data['author'] else None
+        if self.kind == 'comment':
+            self.submission = FakeSubmissionLink(data['link_title'], data['link_permalink'])
+
+
+class FakeSubmissionLink():
+
+    def __init__(self, title, permalink):
+        self.title = title
+        self.permalink = permalink
+
+
+class FakeListing():
+    """ get_comments and get_new of a subreddit, newest first with paging """
+
+    def __init__(self, latency):
+        self.latency = latency
+        # oldest first
+        self.items = []
+
+    def __call__(self, limit=None, params=None):
+        time.sleep(self.latency)
+        params = params or {}
+        # praw sends the limit of params when limit is 0
+        limit = limit or params.get('limit', 25)
+        items = self.items[::-1]
+        fullnames = [item.fullname for item in items]
+        after = params.get('after')
+        before = params.get('before')
+        if before:
+            # the limit items right after before, newest first
+            items = items[:fullnames.index(before)] if before in fullnames else []
+            return iter(items[-limit:])
+        if after:
+            items = items[fullnames.index(after) + 1:] if after in fullnames else []
+        return iter(items[:limit])
+
+
+class FakeUser():
+
+    def __init__(self, r):
+        self.r = r
+
+    def mark_as_read(self, msgs):
+        read = set(msg.id for msg in msgs)
+        self.r.unread = [msg for msg in self.r.unread if msg.id not in read]
+
+
+class FakeReddit():
+    """ the praw calls of the bot, sends are recorded with their time """
+
+    def __init__(self, latency=0, send_latency=0):
+        self.latency = latency
+        self.send_latency = send_latency
+        self.comments = FakeListing(latency)
+        self.submissions = FakeListing(latency)
+        self.unread = []
+        self.user = FakeUser(self)
+        # (time, thing_id, user, subject, body)
+        self.sent = []
+
+    def get_subreddit(self, name):
+        return self
+
+    def get_comments(self, limit=None, params=None):
+        return self.comments(limit, params)
+
+    def get_new(self, limit=None, params=None):
+        return self.submissions(limit, params)
+
+    def get_unread(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return iter(self.unread[::-1])
+
+    def deliver(self, item):
+        if item.kind == 'comment':
+            self.comments.items.append(item)
+        elif item.kind == 'submission':
+            self.submissions.items.append(item)
+        else:
+            self.unread.append(item)
+
+    def _add_comment(self, thing_id, text):
+        time.sleep(self.send_latency)
+        self.sent.append((time.time(), thing_id, None, None, text))
+
+    def send_message(self, user, subject, body):
+        time.sleep(self.send_latency)
+        self.sent.append((time.time(), None, str(user), subject, body))
+
+
+class WriteCounter():
+    """ counts the statements changing the db and the commits """
+
+    def __init__(self, conn):
+        self.writes = 0
+        self.commits = 0
+        conn.set_trace_callback(self)
+
+    def __call__(self, statement):
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+            self.writes += 1
+        elif verb == 'COMMIT':
+            self.commits += 1
+
+
+def loadItems(path):
+    with open(path, 'r') as f:
+        return [FakeThing(json.loads(line)) for line in f if line.strip()]
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': values[-1]}
+
+
+def replay(items, batch, latency=0, send_latency=0, tmp_dir=None):
+    """
+    delivers items batch at a time and runs one bot cycle per batch,
+    returns the report and the sent replies
+    """
+    tmp_dir = tmp_dir or tempfile.mkdtemp()
+    db = commentDB.DB(os.path.join(tmp_dir, 'replay.db'))
+    # sending is not what is measured, the bucket never runs dry
+    replies = outbox.Outbox(db, outbox.TokenBucket(rate=float('inf'), capacity=float('inf')))
+    pm_throttle = throttle.Throttle(bot.pm_limit, bot.pm_time_limit)
+    card_db, spell_check = helper.loadCards()
+    r = FakeReddit(latency, send_latency)
+    writes = WriteCounter(db.conn)
+    cursors = {}
+    # fullname -> time the cycle that got it started
+    arrived = {}
+    new_items = 0
+
+    start = time.perf_counter()
+    for i in range(0, len(items), batch):
+        for item in items[i:i + batch]:
+            r.deliver(item)
+        cycle_start = time.time()
+        with db.transaction():
+            for source, fetch in bot.fetchers.items():
+                found = fetch(r, cursors.get(source))
+                for item in found:
+                    arrived.setdefault(item.fullname, cycle_start)
+                if source == 'comments':
+                    new_items += bot.answerComments(r, db, card_db, spell_check, replies, found)
+                elif source == 'submissions':
+                    new_items += bot.answerSubmissions(r, db, card_db, spell_check, replies, found)
+                else:
+                    new_items += bot.answerPMs(r, db, pm_throttle, card_db, spell_check,
+                                               replies, found)
+                if source != 'pms' and found:
+                    cursors[source] = (found[0].fullname, found[0].created_utc)
+                    db.setCursor(source, *cursors[source])
+        replies.send(r)
+    duration = time.perf_counter() - start
+
+    bot.parser.close()
+    db.close()
+    shutil.rmtree(tmp_dir)
+
+    latencies = [sent_time - arrived[thing_id] for sent_time, thing_id, _, _, _ in r.sent
+                 if thing_id in arrived]
+    report = {
+        'items': len(items),
+        'new_items': new_items,
+        'replies': len(r.sent),
+        'seconds': duration,
+        'items_per_second': len(items) / duration if duration else None,
+        'reply_latency_ms': {name: value * 1000 for name, value in percentiles(latencies).items()},
+        'sqlite_writes': writes.writes,
+        'sqlite_commits': writes.commits,
+        'sqlite_writes_per_item': writes.writes / len(items) if items else None,
+        'stage_seconds': {','.join(str(value) for _, value in labels): seconds
+                          for labels, seconds in metrics.sums('stage_seconds').items()}
+    }
+    # the send order follows the cycles, what is sent must not
+    sent = sorted(({'thing_id': thing_id, 'user': user, 'subject': subject, 'body': body}
+                   for _, thing_id, user, subject, body in r.sent),
+                  key=lambda reply: (reply['thing_id'] or '', reply['user'] or '',
+                                     reply['subject'] or '', reply['body']))
+    return report, sent
+
+
+def diffReplies(expected, sent):
+    """ number of replies missing or new compared to expected, a few are logged """
+    expected = collections.Counter(json.dumps(reply, sort_keys=True) for reply in expected)
+    sent = collections.Counter(json.dumps(reply, sort_keys=True) for reply in sent)
+    missing = list((expected - sent).elements())
+    new = list((sent - expected).elements())
+    for reply in missing[:5]:
+        log.warning('not sent: %s', reply)
+    for reply in new[:5]:
+        log.warning('not expected: %s', reply)
+    return len(missing) + len(new)
+
+
+def run(args):
+    items = loadItems(args.capture)
+    report, sent = replay(items, args.batch, args.latency, args.send_latency)
+    print(json.dumps(report, sort_keys=True, indent=2))
+
+    if args.save_replies:
+        with open(args.save_replies, 'w', newline='\n') as f:
+            for reply in sent:
+                f.write(json.dumps(reply, sort_keys=True) + '\n')
+    if args.expect:
+        with open(args.expect, 'r') as f:
+            expected = [json.loads(line) for line in f if line.strip()]
+        differ = diffReplies(expected, sent)
+        if differ:
+            log.error('%s replies differ from %s', differ, args.expect)
+            return 1
+    return 0
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='offline replay of captured reddit items')
+    commands = arg_parser.add_subparsers(dest='command')
+    commands.required = True
+
+    capture_parser = commands.add_parser('capture', help='save the current listings')
+    capture_parser.add_argument('-o', '--output', default='capture.jsonl')
+    capture_parser.add_argument('--limit', type=int, default=100,
+                                help='items per listing (100)')
+
+    run_parser = commands.add_parser('run', help='replay a capture through the bot')
+    run_parser.add_argument('capture')
+    run_parser.add_argument('--batch', type=int, default=50,
+                            help='items delivered per bot cycle (50)')
+    run_parser.add_argument('--latency', type=float, default=0,
+                            help='seconds every listing request takes')
+    run_parser.add_argument('--send-latency', type=float, default=0,
+                            help='seconds every reply and message takes')
+    run_parser.add_argument('--save-replies', help='write the sent replies as jsonl')
+    run_parser.add_argument('--expect', help='exit 1 if the replies differ from this file, '
+                            'digests of forwarded pms depend on --batch')
+    args = arg_parser.parse_args()
+
+    log.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=log.WARNING)
+    if args.command == 'capture':
+        log.getLogger().setLevel(log.INFO)
+        capture(args)
+        return 0
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
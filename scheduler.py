@@ -0,0 +1,75 @@
+import time
+
+
+class Source():
+    """ polling state of one source """
+
+    def __init__(self, min_interval, max_interval, target, limit = None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # new items wanted per poll, the interval follows from the rate
+        self.target = target
+        # page size, a full page of new items means we fell behind
+        self.limit = limit
+        self.interval = min_interval
+        # new items per second, None until the first poll
+        self.rate = None
+        self.next_poll = 0
+        self.last_poll = None
+        self.started = None
+
+
+class Scheduler():
+    """
+    polls every source as often as its arrival rate needs.
+    the rate is a moving average of new items per second, the interval is
+    the time target new items take to arrive, kept within the bounds
+    """
+
+    def __init__(self, sources, alpha = 0.3):
+        self.sources = sources
+        # weight of the newest rate sample
+        self.alpha = alpha
+
+    def due(self, now = None):
+        """ sources to poll now, they are rescheduled in case the poll fails """
+        now = now or time.time()
+        due = []
+        for name, source in self.sources.items():
+            if now >= source.next_poll:
+                source.started = now
+                source.next_poll = now + source.interval
+                due.append(name)
+        return due
+
+    def nextPoll(self):
+        return min(source.next_poll for source in self.sources.values())
+
+    def update(self, name, new_items, now = None):
+        """ a poll of name started by due() found new_items """
+        source = self.sources[name]
+        started = source.started or now or time.time()
+
+        if source.last_poll is not None and started > source.last_poll:
+            sample = new_items / (started - source.last_poll)
+            if source.rate is None:
+                source.rate = sample
+            else:
+                source.rate = self.alpha * sample + (1 - self.alpha) * source.rate
+        source.last_poll = started
+
+        if source.limit and new_items >= source.limit:
+            # more arrived than we can see, catch up as fast as allowed
+            interval = source.min_interval
+        elif not source.rate:
+            interval = source.max_interval if source.rate == 0 else source.min_interval
+        else:
+            interval = source.target / source.rate
+        source.interval = min(source.max_interval, max(source.min_interval, interval))
+        source.next_poll = started + source.interval
+
+    def stats(self):
+        """ current interval and rate (items per minute) of all sources """
+        return {name: {'interval': round(source.interval, 1),
+                       'rate': round(source.rate * 60, 2) if source.rate is not None else None}
+                for name, source in self.sources.items()}
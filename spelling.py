@@ -1,35 +1,136 @@
-
-import string
+import bisect
+import collections
 import itertools
 
-"""
-# distance 2
-def known_edits2(word):
-    print("known_edits2")
-    return set(e2 for e1 in edits1(word) for e2 in edits1(e1) if e2 in NWORDS)
-"""
+import numpy
+
 
 class Checker():
     """
-    based on Peter Norvig - http://norvig.com/spell-correct.html
+    symmetric delete spelling correction, based on Wolf Garbe's SymSpell
+    https://github.com/wolfgarbe/SymSpell
+
+    all deletes of all names are precomputed, so a correction only has to
+    look up the deletes of the word instead of probing every possible edit
     """
-    def __init__(self, names):
+    def __init__(self, names, max_distance=1, memo_size=10000):
         self.model = set(names)
-
-    def _known(self, words):
-        for w in words:
-            if w in self.model:
-                return w
-        return None
+        self.max_distance = max_distance
+        self.memo_size = memo_size
+        self._names = sorted(self.model)
+        self._deletes = collections.defaultdict(list)
+        for name in self._names:
+            for delete in self._edits(name):
+                self._deletes[delete].append(name)
+        self._memo = {}
+        self._unfixable = set()
 
     def _edits(self, word):
-        splits     = [(word[:i], word[i:]) for i in range(len(word) + 1)]
-        deletes    = (a + b[1:] for a, b in splits if b)
-        transposes = (a + b[1] + b[0] + b[2:] for a, b in splits if len(b)>1)
-        replaces   = (a + c + b[1:] for a, b in splits for c in string.ascii_lowercase if b)
-        inserts    = (a + c + b     for a, b in splits for c in string.ascii_lowercase)
-        return itertools.chain(deletes, transposes, replaces, inserts)
+        """ word and all words with up to max_distance characters deleted """
+        edits = {word}
+        last = edits
+        for _ in range(self.max_distance):
+            last = {w[:i] + w[i+1:] for w in last for i in range(len(w))}
+            edits |= last
+        return edits
+
+    def _distance(self, a, b):
+        """ optimal string alignment distance, capped at max_distance + 1 """
+        limit = self.max_distance
+        big = limit + 1
+        if abs(len(a) - len(b)) > limit:
+            return big
+        # only cells within limit of the diagonal can stay below the cap
+        prev2 = None
+        prev = [min(j, big) for j in range(len(b) + 1)]
+        for i in range(1, len(a) + 1):
+            cur = [big] * (len(b) + 1)
+            cur[0] = min(i, big)
+            for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+                cost = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + (a[i-1] != b[j-1]))
+                if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                    cost = min(cost, prev2[j-2] + 1)
+                cur[j] = min(cost, big)
+            # no later row can get below the smallest value of this row
+            if min(cur) == big:
+                return big
+            prev2, prev = prev, cur
+        return prev[-1]
+
+    def _lookup(self, word):
+        candidates = set(itertools.chain.from_iterable(
+                self._deletes.get(delete, ()) for delete in self._edits(word)))
+        best = None
+        for name in sorted(candidates):
+            distance = self._distance(word, name)
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, name)
+        return best and best[1]
+
+    def isPrefix(self, word):
+        """ true if a known name starts with word """
+        i = bisect.bisect_left(self._names, word)
+        return i < len(self._names) and self._names[i].startswith(word)
 
     def correct(self, word):
         """ returns input word or fixed version if found """
-        return self._known([word]) or self._known(self._edits(word)) or word
+        if word in self.model or word in self._unfixable:
+            return word
+        fixed = self._memo.get(word)
+        if fixed:
+            return fixed
+
+        fixed = self._lookup(word)
+        # users can send anything, keep the memo from growing forever
+        if len(self._memo) + len(self._unfixable) >= self.memo_size:
+            self._memo.clear()
+            self._unfixable.clear()
+        if fixed:
+            self._memo[word] = fixed
+            return fixed
+        self._unfixable.add(word)
+        return word
+
+
+class Suggester():
+    """
+    finds similar names by their character trigrams, for words too broken
+    for Checker. all names are one trigram matrix, a word is scored against
+    all names at once with a sum over the rows of its trigrams
+    """
+    def __init__(self, names, min_score=0.3):
+        self.names = sorted(set(names))
+        self.min_score = min_score
+        self._grams = {}
+        name_grams = [self._trigrams(name) for name in self.names]
+        for grams in name_grams:
+            for gram in grams:
+                self._grams.setdefault(gram, len(self._grams))
+
+        # trigram x name, a name is scored by summing the rows of a word
+        self._matrix = numpy.zeros((len(self._grams), len(self.names)), dtype=numpy.uint8)
+        rows = [self._grams[gram] for grams in name_grams for gram in grams]
+        cols = [col for col, grams in enumerate(name_grams) for gram in grams]
+        self._matrix[rows, cols] = 1
+        self._norms = numpy.sqrt(self._matrix.sum(axis=0, dtype=numpy.float32))
+
+    @staticmethod
+    def _trigrams(word):
+        padded = '^' + word + '$'
+        return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+    def suggest(self, word, count=3):
+        """ up to count (name, score) pairs, best first """
+        grams = self._trigrams(word)
+        rows = [self._grams[gram] for gram in grams if gram in self._grams]
+        if not rows:
+            return []
+
+        # cosine similarity of the trigram sets
+        scores = self._matrix[rows].sum(axis=0) / (self._norms * numpy.sqrt(len(grams)))
+        if count < len(scores):
+            top = numpy.argpartition(-scores, count)[:count]
+        else:
+            top = numpy.arange(len(scores))
+        top = sorted(top, key=lambda i: (-scores[i], self.names[i]))
+        return [(self.names[i], float(scores[i])) for i in top if scores[i] >= self.min_score]
@@ -0,0 +1,67 @@
+import collections
+import heapq
+import logging as log
+import time
+
+
+class Throttle():
+    """
+    allows every key limit events per window seconds (sliding window).
+    a heap holds the time the oldest event of each key leaves the window,
+    so expiring costs only the expired keys
+    """
+
+    def __init__(self, limit = 1, window = 90):
+        self.limit = limit
+        self.window = window
+        # key -> event times, oldest first
+        self._events = {}
+        # (oldest event time + window, key), one entry per key
+        self._expiry = []
+        # (key, time) events added since the last save
+        self._unsaved = []
+
+    def __len__(self):
+        return len(self._events)
+
+    def allowed(self, key, now = None):
+        """ true if key may have another event now """
+        self.expire(now)
+        return len(self._events.get(key, ())) < self.limit
+
+    def add(self, key, now = None):
+        now = now or time.time()
+        events = self._events.setdefault(key, collections.deque())
+        if not events:
+            heapq.heappush(self._expiry, (now + self.window, key))
+        events.append(now)
+        self._unsaved.append((key, now))
+
+    def expire(self, now = None):
+        now = now or time.time()
+        while self._expiry and self._expiry[0][0] <= now:
+            _, key = heapq.heappop(self._expiry)
+            events = self._events[key]
+            while events and events[0] + self.window <= now:
+                events.popleft()
+            if events:
+                heapq.heappush(self._expiry, (events[0] + self.window, key))
+            else:
+                log.debug("removing %s from throttle", key)
+                del self._events[key]
+
+    def events(self):
+        """ all (key, time) events in the window """
+        return [(key, event) for key, events in self._events.items() for event in events]
+
+    def unsaved(self):
+        """ (key, time) events added since the last call, they are saved now """
+        events, self._unsaved = self._unsaved, []
+        return events
+
+    def load(self, events):
+        """ adds saved (key, time) events, see events() """
+        for key, event in sorted(events, key=lambda e: e[1]):
+            self.add(key, event)
+        self.expire()
+        self._unsaved = []
@@ -1,5 +1,8 @@
 #!/usr/bin/python
 
+import argparse
+import concurrent.futures
+import copy
 import itertools
 import json
 import logging as log
@@ -7,101 +10,356 @@ import os
 import os.path
 import time
 
-import praw
-
 import commentDB
 import credentials
 import helper
-import spelling
+import metrics
+import outbox
+import profiling
+import scheduler
+import throttle
 
 info_body_templ = None
 duplicate_header_templ = ("You've posted a comment reply in [{title}]({url}) "
                             "with cards I already explained there. "
                             "Here are the cards just for you:\n\n")
 forward_subject_templ = '/u/{}: "{}"'
-# answer pms of the same user only every x seconds
+digest_subject_templ = '{} messages without cards'
+digest_entry_templ = '**{subject}**\n\n{body}\n\n---\n\n'
+# reddit rejects longer messages
+message_max_length = 10000
+# parses a backlog of comments on all cores if XWING_PARSE_POOL is set
+parser = helper.BatchParser(helper.PARSE_POOL_SIZE)
+# answer pm_limit pms of the same user every pm_time_limit seconds
+pm_limit = 1
 pm_time_limit = 90
+# prometheus textfile, written every cycle
+metrics_file = 'xwingminibot.prom'
+# reddit archives threads after 6 months, nobody can ask for cards there anymore.
+# a thread is always older than the cards posted in it
+topcomment_ttl = 180 * 24 * 60 * 60
 SUBS_STRING = '+'.join(credentials.subreddits)
-
-
-def answerComments(r, db, card_db, spell_check):
-    """ read and answer comments """
-
-    comments = r.get_subreddit(SUBS_STRING).get_comments(limit=250)
+# seconds to wait for a source, a slow one is picked up again next cycle
+fetch_timeouts = {'comments': 25, 'submissions': 25, 'pms': 25}
+# first page of a poll, later pages are only read to catch up
+comment_page = 50
+submission_page = 10
+# most items read to catch up with the cursor, the rest follows next poll
+comment_catch_up = 1000
+submission_catch_up = 100
+# items read without a cursor, the first start or a lost cursor
+comment_cold_start = 250
+submission_cold_start = 20
+# a deleted cursor item also returns empty pages, every this many empty polls
+# of the same cursor one more request checks for it
+cursor_check_every = 10
+# empty polls per cursor fullname
+empty_polls = {}
+# poll intervals follow the arrival rate of each source:
+# min and max seconds between polls, new items wanted per poll, catch up size.
+# reddit caches the listings for 30 sec, polling faster finds nothing new
+poll_sources = {
+    'comments': (32, 300, comment_page, comment_catch_up),
+    'submissions': (32, 600, submission_page, submission_catch_up),
+    'pms': (15, 120, 1)
+}
+
+
+def fetchSince(listing, cursor, first_page, max_items, cold_start):
+    """
+    newest first, the items of listing newer than cursor (fullname, created).
+    reddit returns the items right after before=cursor, so a quiet poll
+    downloads only the new ones. a backlog is read forward from the cursor
+    in pages, up to max_items, the newer items come with the next poll.
+    without cursor the newest cold_start items are read. every
+    cursor_check_every empty polls the newest item shows if the cursor is gone
+    """
+    if not cursor:
+        return list(listing(limit=cold_start))
+
+    items = []
+    before = cursor[0]
+    page = first_page
+    while True:
+        # a single request, praw would go on with after on short pages
+        page_items = list(listing(limit=0, params={'before': before, 'limit': page}))
+        items = page_items + items
+        if len(page_items) < page:
+            break
+        if len(items) >= max_items:
+            log.warning('more than %s new items since %s, catching up next poll',
+                        max_items, cursor[0])
+            empty_polls.pop(cursor[0], None)
+            return items
+        before = page_items[0].fullname
+        # reddit pages have at most 100 items
+        page = min(100, max_items - len(items))
+
+    if items:
+        empty_polls.pop(cursor[0], None)
+        return items
+
+    # nothing after a deleted cursor item either, now and then check the newest one
+    empty_polls[cursor[0]] = empty_polls.get(cursor[0], 0) + 1
+    if empty_polls[cursor[0]] % cursor_check_every == 0:
+        newest = list(listing(limit=1))
+        if newest and newest[0].fullname != cursor[0] and newest[0].created_utc >= cursor[1]:
+            log.info('cursor %s is gone, reading back to its time', cursor[0])
+            empty_polls.pop(cursor[0], None)
+            return fetchBack(listing, cursor, first_page, max_items)
+    return items
+
+
+def fetchBack(listing, cursor, first_page, max_items):
+    """
+    newest first, the items of listing created after cursor (fullname, created),
+    paged backward from the newest item. anything past max_items is missed
+    """
+    items = []
+    params = {}
+    page = first_page
+    while True:
+        page_items = list(listing(limit=page, params=params))
+        for item in page_items:
+            if item.fullname == cursor[0] or item.created_utc < cursor[1]:
+                return items
+            items.append(item)
+
+        if len(page_items) < page:
+            return items
+        if len(items) >= max_items:
+            log.warning('more than %s new items since %s, older ones are missed',
+                        max_items, cursor[0])
+            return items
+        params = {'after': page_items[-1].fullname}
+        page = min(100, max_items - len(items))
+
+
+@metrics.timed('stage_seconds', stage='fetch_comments')
+def fetchComments(r, cursor=None):
     # testing
     #comments = r.get_subreddit('sandboxtest').get_comments(limit=10)
     #comments = r.get_submission(submission_id='12345').comments
     #comments = praw.helpers.flatten_tree(comments)
     #comments = r.get_submission('https://www.reddit.com/r/hearthstone/comments/12345/_/1234').comments
 
+    return fetchSince(r.get_subreddit(SUBS_STRING).get_comments,
+                      cursor, comment_page, comment_catch_up, comment_cold_start)
+
+
+@metrics.timed('stage_seconds', stage='fetch_submissions')
+def fetchSubmissions(r, cursor=None):
+    return fetchSince(r.get_subreddit(SUBS_STRING).get_new,
+                      cursor, submission_page, submission_catch_up, submission_cold_start)
+
+
+@metrics.timed('stage_seconds', stage='fetch_inbox')
+def fetchPMs(r, cursor=None):
+    # unread messages need no cursor, mark as read removes them
+    return list(r.get_unread(unset_has_mail=True, update_user=True))
+
+
+fetchers = {
+    'comments': fetchComments,
+    'submissions': fetchSubmissions,
+    'pms': fetchPMs
+}
+
+
+def fetchSession(r):
+    """
+    shallow copy of r for one fetch thread, sharing its connections.
+    praw sessions are not thread safe, every request sets and clears
+    r._use_oauth. a copy that refreshes an expired token hands it to r
+    """
+    session = copy.copy(r)
+    refresh = session.refresh_access_information
+
+    def refreshShared(*args, **kwargs):
+        response = refresh(*args, **kwargs)
+        r._authentication = session._authentication
+        r.access_token = session.access_token
+        r.refresh_token = session.refresh_token
+        return response
+
+    session.refresh_access_information = refreshShared
+    return session
+
+
+def startFetches(executor, running, r, sources, cursors):
+    """ starts a fetch for the sources without one still running """
+    now = time.time()
+    for source in sources:
+        fetch = fetchers[source]
+        if source in running:
+            log.warning('%s fetch still running from last cycle', source)
+            future = running[source][0]
+        else:
+            future = executor.submit(fetch, fetchSession(r), cursors.get(source))
+        running[source] = (future, now + fetch_timeouts[source])
+
+
+def finishedFetches(running):
+    """
+    yields source, items of the running fetches as they finish.
+    failed fetches are logged and skipped, fetches past their timeout
+    stay in running and are skipped this cycle
+    """
+    waiting = dict(running)
+    while waiting:
+        deadline = min(deadline for _, deadline in waiting.values())
+        done, _ = concurrent.futures.wait([future for future, _ in waiting.values()],
+                                          timeout=max(0, deadline - time.time()),
+                                          return_when=concurrent.futures.FIRST_COMPLETED)
+        now = time.time()
+        for source, (future, deadline) in list(waiting.items()):
+            if future in done:
+                del waiting[source]
+                del running[source]
+                try:
+                    items = future.result()
+                except:
+                    log.exception('fetching %s failed', source)
+                    metrics.count('errors_total', source=source, stage='fetch')
+                    continue
+                yield source, items
+            elif now >= deadline:
+                del waiting[source]
+                log.warning('fetching %s timed out', source)
+                metrics.count('errors_total', source=source, stage='timeout')
+
+
+def answerComments(r, db, card_db, spell_check, replies, comments=None):
+    """ read and answer comments, returns the number of new comments """
+
+    if comments is None:
+        comments = fetchComments(r)
+
+    seen_ids = []
+    new_comments = []
     for comment in comments:
-        log.info('Got a comment')
+        log.debug('Got a comment %s', comment.id)
 
-        if db.isSeenComment(comment.id):
+        if comment.id in seen_ids or db.isSeenComment(comment.id):
             break
+        seen_ids.append(comment.id)
 
-        log.info('Adding seen')
-        db.addSeenComment(comment.id)
+        # our replies link [[cardname]], never answer them
+        if comment.author and comment.author.name == credentials.username:
+            continue
+        new_comments.append(comment)
 
-        #if comment.author.name == credentials.username:
-        #    continue
+    log.debug('Adding seen %s', seen_ids)
+    db.addSeenComments(seen_ids)
+    # seen has to be on disk before we answer
+    db.commit()
 
-        body = helper.removeQuotes(comment.body)
-        cards = helper.getCardsFromComment(body, spell_check)
+    bodies = [comment.body for comment in new_comments]
+    found = parser.parse(card_db, spell_check, bodies, ignore_quotes=True)
+
+    # posting and db writes stay here, in fetch order
+    for comment, (cards, comment_text) in zip(new_comments, found):
         if cards:
             log.debug("found cards: %s", cards)
-            comment_text = helper.getTextForCards(card_db, cards)
 
             if comment_text:
-                if db.exists(comment.parent_id, cards):
+                # names without a match only got a suggestion, they are not posted
+                answered = helper.answeredCards(card_db, cards)
+                if answered and db.exists(comment.parent_id, answered):
                     #send pm instead of comment reply
                     sub = comment.submission
                     log.info("sending duplicate msg: %s with %s", comment.author, cards)
                     header = duplicate_header_templ.format(title=sub.title, url=sub.permalink)
                     msg_text = header + comment_text
-                    r.send_message(comment.author, 'You requested cards in a comment', msg_text)
+                    replies.message(comment.author, 'You requested cards in a comment', msg_text)
                 else:
                     # reply to comment
-                    for card in cards:
-                        db.insert(comment.parent_id, card)
+                    db.insertCards(comment.parent_id, answered)
                     log.info("replying to comment: %s %s with %s", comment.id, comment.author.name, cards)
-                    comment.reply(comment_text)
+                    replies.reply(comment, comment_text)
+
+    return len(seen_ids)
 
 
-def answerSubmissions(r, db, card_db, spell_check):
-    """ read and answer submissions """
+def answerSubmissions(r, db, card_db, spell_check, replies, submissions=None):
+    """ read and answer submissions, returns the number of new submissions """
 
-    submissions = r.get_subreddit(SUBS_STRING).get_new(limit=20)
+    if submissions is None:
+        submissions = fetchSubmissions(r)
 
+    seen_ids = []
+    new_submissions = []
     for submission in submissions:
-        if db.isSeenSubmission(submission.id):
+        if submission.id in seen_ids or db.isSeenSubmission(submission.id):
             break
-        db.addSeenSubmission(submission.id)
+        seen_ids.append(submission.id)
 
         #if submission.author.name == credentials.username:
         #    continue
         if not submission.is_self:
             continue
+        new_submissions.append(submission)
+
+    db.addSeenSubmissions(seen_ids)
+    # seen has to be on disk before we answer
+    db.commit()
 
-        cards = helper.getCardsFromComment(submission.selftext, spell_check)
+    bodies = [submission.selftext for submission in new_submissions]
+    found = parser.parse(card_db, spell_check, bodies)
+
+    for submission, (cards, comment_text) in zip(new_submissions, found):
         if cards:
             log.debug("found cards: %s", cards)
-            comment_text = helper.getTextForCards(card_db, cards)
 
             if comment_text:
                 # reply to submission
                 log.info("replying to submission: %s %s with %s", submission.id, submission.author.name, cards)
-                submission.add_comment(comment_text)
+                replies.reply(submission, comment_text)
+
+    return len(seen_ids)
+
+
+def forwardToAdmin(replies, forwards):
+    """ sends the (subject, body) forwards as few digest messages """
+    if len(forwards) == 1:
+        replies.message(credentials.admin_username, *forwards[0])
+        return
+
+    digest = ''
+    count = 0
+    for subject, body in forwards:
+        entry = digest_entry_templ.format(subject=subject, body=body)
+        if digest and len(digest) + len(entry) > message_max_length:
+            replies.message(credentials.admin_username, digest_subject_templ.format(count), digest)
+            digest = ''
+            count = 0
+        digest += entry
+        count += 1
+    if digest:
+        replies.message(credentials.admin_username, digest_subject_templ.format(count), digest)
+
+
+def answerPMs(r, db, pm_throttle, card_db, spell_check, replies, msgs=None):
+    """ read and answer pms, returns the number of messages """
 
+    if msgs is None:
+        msgs = fetchPMs(r)
 
-def answerPMs(r, pm_user_cache, card_db, spell_check):
-    """ read and answer pms """
+    # mark as read is slow, a message can be unread again in the next poll
+    new_msgs = [msg for msg in msgs if not db.isSeenMessage(msg.id)]
+    db.addSeenMessages(msg.id for msg in new_msgs)
+    # seen has to be on disk before we answer
+    db.commit()
 
-    for msg in r.get_unread(unset_has_mail=True, update_user=True):
-        # mark as read is slow, you might get the same message twice
-        # this is why pm_time_limit has to be > 1 cycle (32 sec)
-        msg.mark_as_read()
+    if msgs:
+        try:
+            r.user.mark_as_read(msgs)
+        except:
+            # they are seen, the next poll tries again
+            log.exception('marking %s messages as read failed', len(msgs))
 
+    forwards = []
+    for msg in new_msgs:
         if msg.was_comment:
             # ignore replies to our own comments
             continue
@@ -109,8 +367,8 @@ def answerPMs(r, pm_user_cache, card_db, spell_check):
         author = msg.author.name
         log.debug("found message with id: %s from %s", msg.id, author)
 
-        if author in pm_user_cache:
-            log.debug("user %s is in recent msg list", author)
+        if not pm_throttle.allowed(author):
+            log.debug("user %s is throttled", author)
             continue
 
         cards = helper.getCardsFromComment(msg.body, spell_check)
@@ -121,100 +379,170 @@ def answerPMs(r, pm_user_cache, card_db, spell_check):
         if cards:
             log.debug("found cards: %s", cards)
 
-            msg_text = helper.getTextForCards(card_db, cards)
+            # info is not a card, don't suggest any for it
+            msg_text = helper.getTextForCards(card_db, [card for card in cards if card != 'info'])
             if 'info' in cards and info_body_templ:
                 msg_text = info_body_templ.format(user=author) + msg_text
 
             if msg_text:
                 log.info("sending msg: %s with %s", author, cards)
-                pm_user_cache[author] = int(time.time()) + pm_time_limit
-                msg.reply(msg_text)
+                pm_throttle.add(author)
+                replies.reply(msg, msg_text)
         else:
             # forward messages without cards to admin
-            r.send_message(credentials.admin_username,
-                           forward_subject_templ.format(author, msg.subject),
-                           msg.body)
-
+            forwards.append((forward_subject_templ.format(author, msg.subject), msg.body))
 
-def cleanPMUserCache(cache):
-    """ clean recent user msg cache """
+    if forwards:
+        forwardToAdmin(replies, forwards)
 
-    now = int(time.time())
-    kill_user = []
+    return len(new_msgs)
 
-    for user, utime in cache.items():
-        if now > utime:
-            log.debug("removing author %s from recent list", user)
-            kill_user.append(user)
 
-    for ku in kill_user:
-        del cache[ku]
+def writeMetrics(card_db, polls, replies):
+    """ current state as gauges, then everything to metrics_file """
+    try:
+        for source, stats in polls.stats().items():
+            metrics.gauge('poll_interval_seconds', stats['interval'], source=source)
+            if stats['rate'] is not None:
+                metrics.gauge('arrival_per_minute', stats['rate'], source=source)
+        metrics.gauge('outbox_size', len(replies))
+        for name, value in card_db.replies.info().items():
+            metrics.gauge('reply_cache_' + name, value)
+        metrics.writeTextfile(metrics_file)
+    except:
+        log.exception('writing metrics failed')
 
 
-def sleep(round_start, rate_sleep):
+def sleep(round_end, r, replies):
+    """ sends queued replies until round_end """
     try:
-        if rate_sleep > 0:
-            time.sleep(rate_sleep)
-        else:
-            # get comments has a 30 sec cache
-            time.sleep(32 - min(32, int(time.time()) - round_start))
+        while True:
+            try:
+                replies.send(r)
+            except:
+                log.exception('something went wrong while sending')
+            now = time.time()
+            if now >= round_end:
+                break
+            wait = replies.wait()
+            if wait is None or now + wait > round_end:
+                wait = round_end - now
+            # at least a second, a failing send must not spin
+            time.sleep(max(1, wait))
     except:
         # this is strange but not horrible, page is cached so nothing really happens
         log.exception('sleep interrupted')
 
 
-def main():
+def main(profiler=None):
     log.debug("reddit bot reader starting")
 
     # init reddit
     r, next_auth_time = helper.initReddit()
     # init sqlite db
     db = commentDB.DB()
-    # load card db
-    card_db = helper.loadCardDB()
-    # init spellchecker with all card names and alternatives
-    spell_check = spelling.Checker(card_db.keys())
+    # deletes old seen ids and posted cards every few minutes
+    retention = commentDB.Retention(db, topcomment_ttl=topcomment_ttl)
+    # replies and pms wait in the db until the rate limit allows them
+    replies = outbox.Outbox(db)
+    log.info('%s queued replies', len(replies))
+    # load card db and spellchecker with all card names and alternatives
+    card_db, spell_check = helper.loadCards()
+    # rebuilds the cards when a new wave is dropped in
+    card_reloader = helper.CardReloader()
     # load info message template
     global info_body_templ
-    # pm spam filter cache
-    pm_user_cache = {}
+    # pm spam filter, survives restarts
+    pm_throttle = throttle.Throttle(pm_limit, pm_time_limit)
+    pm_throttle.load(db.throttleEvents('pm'))
+    # does nothing unless switched on
+    profiler = profiler or profiling.Profiler()
+    profiler.sizes = lambda: {'cards': len(card_db), 'reply_cache': card_db.replies.info()['size'],
+                              'pm_throttle': len(pm_throttle), 'running': len(running)}
+
+    # polls busy sources more often than quiet ones
+    polls = scheduler.Scheduler({source: scheduler.Source(*bounds)
+                                 for source, bounds in poll_sources.items()})
+    # newest item answered per listing, fetches read back to it after a restart
+    cursors = {source: db.cursor(source) for source in ('comments', 'submissions')}
+    # the sources are fetched in parallel, answers are sent from this thread
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(fetchers))
+    running = {}
     # create lockfile for simple, clean shutdown, delete the file to stop bot
     with open('lockfile.lock', 'w'): pass
 
     # actual main loop
     while os.path.isfile('lockfile.lock'):
-        rate_sleep = 0
-        round_start = int(time.time())
-        try:
-            # do we need to refresh token?
-            if round_start > next_auth_time:
-                r, next_auth_time = helper.refreshReddit(r)
-
-            log.info('checking for new comments')
-            answerComments(r, db, card_db, spell_check)
-            log.info('checking for new submissions')
-            answerSubmissions(r, db, card_db, spell_check)
-            log.info('checking for new pms')
-            answerPMs(r, pm_user_cache, card_db, spell_check)
-        except praw.errors.RateLimitExceeded as rle:
-            # happens a lot for accounts without email, <10 days old and some points
-            log.warn("rate exceeded, going to sleep for a long time %s", rle.sleep_time)
-            rate_sleep = rle.sleep_time
-        except:
-            # it's bad practice to catch all but we want to keep running 4ever
-            # this will catch all the connection (reddit maintainance) errors
-            log.exception('something went wrong while redditing')
-
-        cleanPMUserCache(pm_user_cache)
-        db.cleanupSeenComment()
-        db.cleanupSeenSubmission()
-        sleep(round_start, rate_sleep)
+        round_start = time.time()
+        with profiler.cycle():
+            # all db writes of one cycle are committed together
+            with db.transaction():
+                try:
+                    # swap in new cards between cycles
+                    card_db, spell_check = card_reloader.poll(card_db, spell_check)
+
+                    # do we need to refresh token?
+                    if round_start > next_auth_time:
+                        r, next_auth_time = helper.refreshReddit(r)
+
+                    sources = polls.due()
+                    log.info('checking for new %s', ', '.join(sources))
+                    startFetches(executor, running, r, sources, cursors)
+                except:
+                    # it's bad practice to catch all but we want to keep running 4ever
+                    # this will catch all the connection (reddit maintainance) errors
+                    log.exception('something went wrong while redditing')
+
+                answers = {
+                    'comments': lambda items: answerComments(r, db, card_db, spell_check, replies, items),
+                    'submissions': lambda items: answerSubmissions(r, db, card_db, spell_check, replies, items),
+                    'pms': lambda items: answerPMs(r, db, pm_throttle, card_db, spell_check, replies, items)
+                }
+                # one failing source must not keep the others from being answered
+                for source, items in finishedFetches(running):
+                    try:
+                        with metrics.timed('stage_seconds', stage='answer_' + source):
+                            new_items = answers[source](items)
+                        metrics.count('items_total', new_items, source=source)
+                        polls.update(source, new_items)
+                        # newest first, the next poll reads back to this one
+                        if source in cursors and items:
+                            cursors[source] = (items[0].fullname, items[0].created_utc)
+                            db.setCursor(source, *cursors[source])
+                    except:
+                        log.exception('something went wrong while answering %s', source)
+                        metrics.count('errors_total', source=source, stage='answer')
+
+                log.debug('reply cache: %s', card_db.replies.info())
+                log.info('poll intervals: %s', polls.stats())
+                pm_throttle.expire()
+                db.saveThrottleEvents('pm', pm_throttle.unsaved(), time.time() - pm_throttle.window)
+                retention.run()
+
+            metrics.observe('cycle_seconds', time.time() - round_start)
+            writeMetrics(card_db, polls, replies)
+        sleep(polls.nextPoll(), r, replies)
 
     log.warning('leaving hearthscan-bot')
+    executor.shutdown(wait=False)
+    parser.close()
     db.close()
 
 
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='profiling switches override '
+                                         'XWING_PROFILE_CYCLES, XWING_MEMORY_EVERY, '
+                                         'XWING_SLOW_CYCLE and XWING_PROFILE_DIR')
+    arg_parser.add_argument('--profile-cycles', type=int,
+                            help='cProfile the first N cycles, one pstats file each')
+    arg_parser.add_argument('--memory-every', type=int,
+                            help='tracemalloc snapshot every N cycles')
+    arg_parser.add_argument('--slow-cycle', type=float,
+                            help='log cycles slower than SEC seconds with their stages')
+    arg_parser.add_argument('--profile-dir', dest='out_dir',
+                            help='where pstats and snapshots go (default profile)')
+    args = arg_parser.parse_args()
+
     log.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
                     level=log.INFO)
-    main()
\ No newline at end of file
+    main(profiling.Profiler.fromEnv(**vars(args)))
\ No newline at end of file